@@ -0,0 +1,210 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import io
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+class AudioDecodeError(Exception):
+    pass
+
+
+# Decode counters per path ("wav" and "soundfile" in-process, "ffmpeg" subprocess)
+# and per uploaded format, the latter with bytes to show how well uploads compress
+decode_lock = threading.Lock()
+decode_stats = {
+    path: {"count": 0, "seconds": 0.0, "audio_seconds": 0.0}
+    for path in ("wav", "soundfile", "ffmpeg")
+}
+format_stats = {}
+# ffmpeg seconds per audio second assumed before any upload went through ffmpeg,
+# mostly its startup spread over a typical 10 s chunk. measure_ffmpeg_baseline
+# replaces it with a measurement on this machine.
+FFMPEG_BASELINE_SECONDS_PER_AUDIO_SECOND = 0.005
+ffmpeg_baseline = FFMPEG_BASELINE_SECONDS_PER_AUDIO_SECOND
+
+
+def audio_format(data):
+    head = bytes(data[:36])
+    if head.startswith(b"RIFF"):
+        return "wav"
+    if head.startswith(b"fLaC"):
+        return "flac"
+    if head.startswith(b"OggS"):
+        return "opus" if b"OpusHead" in head else "ogg"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "webm"
+    if head.startswith(b"ID3") or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "mp3"
+    return "other"
+
+
+def _record(path, start, audio, data):
+    elapsed = time.time() - start
+    audio_seconds = len(audio) / SAMPLE_RATE
+    with decode_lock:
+        stats = decode_stats[path]
+        stats["count"] += 1
+        stats["seconds"] += elapsed
+        stats["audio_seconds"] += audio_seconds
+        stats = format_stats.setdefault(audio_format(data), {"count": 0, "bytes": 0, "seconds": 0.0, "audio_seconds": 0.0})
+        stats["count"] += 1
+        stats["bytes"] += len(data)
+        stats["seconds"] += elapsed
+        stats["audio_seconds"] += audio_seconds
+
+
+def get_decode_stats():
+    with decode_lock:
+        stats = {path: dict(values) for path, values in decode_stats.items()}
+    # Time the in-process path saved compared to the average ffmpeg cost per audio
+    # second, the baseline until uploads went through ffmpeg
+    wav, ffmpeg = stats["wav"], stats["ffmpeg"]
+    if ffmpeg["audio_seconds"] > 0:
+        ffmpeg_cost = ffmpeg["seconds"] / ffmpeg["audio_seconds"]
+    else:
+        ffmpeg_cost = ffmpeg_baseline
+    stats["ffmpeg_seconds_per_audio_second"] = ffmpeg_cost
+    stats["estimated_seconds_saved"] = max(0.0, wav["audio_seconds"] * ffmpeg_cost - wav["seconds"])
+    with decode_lock:
+        stats["formats"] = {name: dict(values) for name, values in format_stats.items()}
+    for values in stats["formats"].values():
+        values["bytes_per_audio_second"] = values["bytes"] / values["audio_seconds"] if values["audio_seconds"] else 0.0
+    return stats
+
+
+def measure_ffmpeg_baseline(audio):
+    # Times ffmpeg on audio (float32 at SAMPLE_RATE) encoded as WAV, without counting
+    # it as a decode. Keeps the configured baseline when ffmpeg is not available.
+    global ffmpeg_baseline
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes((np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+    start = time.time()
+    try:
+        _ffmpeg("pipe:0", buffer.getvalue())
+    except AudioDecodeError:
+        return None
+    ffmpeg_baseline = (time.time() - start) / (len(audio) / SAMPLE_RATE)
+    return ffmpeg_baseline
+
+
+def _wav_samples(data):
+    # Returns float32 samples for 16 kHz 16-bit PCM WAV (what client.py records),
+    # or None when the file needs resampling or another codec
+    view = memoryview(data)
+    if len(view) < 12 or view[:4] != b"RIFF" or view[8:12] != b"WAVE":
+        return None
+    offset = 12
+    channels = None
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        chunk_size = struct.unpack_from("<I", view, offset + 4)[0]
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            # A cut off fmt chunk is left to ffmpeg to reject
+            if chunk_size < 16 or body + 16 > len(view):
+                return None
+            audio_format, channels, rate, _, _, bits = struct.unpack_from("<HHIIHH", view, body)
+            if audio_format != 1 or bits != 16 or rate != SAMPLE_RATE or channels not in (1, 2):
+                return None
+        elif chunk_id == b"data":
+            if channels is None:
+                return None
+            # Streamed WAVs may leave the size unset, use whatever was sent
+            end = min(len(view), body + chunk_size)
+            count = (end - body) // (2 * channels)
+            samples = np.frombuffer(view, np.int16, count * channels, body)
+            if channels == 2:
+                samples = samples.reshape(-1, 2).mean(axis=1)
+            return samples.astype(np.float32) / 32768.0
+        offset = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+def _soundfile_samples(data):
+    # FLAC (and Ogg/Opus with libsndfile 1.0.29+) decoded in-process when the
+    # optional soundfile package is installed, None when ffmpeg has to do it
+    if audio_format(data) not in ("flac", "opus", "ogg"):
+        return None
+    try:
+        import soundfile
+    except ImportError:
+        return None
+    try:
+        samples, rate = soundfile.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    except (RuntimeError, ValueError):
+        return None
+    if rate != SAMPLE_RATE:
+        return None
+    return samples.mean(axis=1) if samples.shape[1] > 1 else samples[:, 0]
+
+
+def _can_pipe(data):
+    # Formats ffmpeg can read from stdin. Others (e.g. MP4/M4A with the index at
+    # the end of the file) need a seekable input and go through a temp file.
+    head = bytes(data[:4])
+    return (head.startswith(b"RIFF") or head.startswith(b"ID3") or head.startswith(b"fLaC")
+            or head.startswith(b"OggS") or head.startswith(b"\x1a\x45\xdf\xa3")
+            or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"))
+
+
+def _ffmpeg(source, data=None):
+    cmd = [
+        "ffmpeg",
+        "-threads", "0",
+        "-i", source,
+        "-f", "s16le",
+        "-ac", "1",
+        "-acodec", "pcm_s16le",
+        "-ar", str(SAMPLE_RATE),
+        "-",
+    ]
+    if data is None:
+        cmd.insert(1, "-nostdin")
+    try:
+        return subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise AudioDecodeError(f"Failed to decode audio: {e.stderr.decode(errors='replace')[-500:]}")
+    except OSError as e:
+        # ffmpeg is missing or could not be started
+        raise AudioDecodeError(f"Failed to run ffmpeg: {e}")
+
+
+def decode_audio(data):
+    # Returns 16 kHz mono float32 samples, the input every Whisper engine accepts
+    start = time.time()
+    audio = _wav_samples(data)
+    if audio is not None:
+        _record("wav", start, audio, data)
+        return audio
+    audio = _soundfile_samples(data)
+    if audio is not None:
+        _record("soundfile", start, audio, data)
+        return audio
+    if _can_pipe(data):
+        pcm = _ffmpeg("pipe:0", data)
+    else:
+        with tempfile.NamedTemporaryFile(delete=False) as temp_audio_file:
+            temp_audio_file.write(data)
+            temp_file_path = temp_audio_file.name
+        try:
+            pcm = _ffmpeg(temp_file_path)
+        finally:
+            os.remove(temp_file_path)
+    audio = np.frombuffer(pcm, np.int16).astype(np.float32) / 32768.0
+    _record("ffmpeg", start, audio, data)
+    return audio
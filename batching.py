@@ -0,0 +1,109 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from inference_pool import QueueFullError, PRIORITIES, DEFAULT_PRIORITY
+
+
+class MicroBatcher:
+    # Gathers requests for the same key (model) that arrive within max_wait seconds
+    # of each other, up to max_batch of them, and runs them as one call of
+    # run_batch(key, items) on the inference pool. Each caller gets a Future for
+    # its own item's result. Priority classes are batched separately and keep
+    # their class on the pool. When more items wait than fit in one batch,
+    # clients take turns so one client's backlog fills no batch on its own.
+    def __init__(self, run_batch, pool, max_batch=8, max_wait=0.05):
+        self.run_batch = run_batch
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.batched_items = 0
+        self.largest_batch = 0
+        self.thread = threading.Thread(target=self._collect, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, key, item, priority=DEFAULT_PRIORITY, client=None, cost=1.0):
+        future = Future()
+        with self.condition:
+            self.pending.setdefault((key, priority), []).append((future, item, time.time(), client, cost))
+            self.condition.notify()
+        return future
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "average_batch_size": self.batched_items / self.batches if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+            }
+
+    def _collect(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # The most urgent class first, oldest group within a class
+                key, waiting = min(self.pending.items(), key=lambda pending: PRIORITIES.index(pending[0][1]))
+                deadline = waiting[0][2] + self.max_wait
+                while len(waiting) < self.max_batch:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self._take(waiting)
+                if waiting:
+                    self.pending.move_to_end(key)
+                else:
+                    del self.pending[key]
+            self._dispatch(key, batch)
+
+    def _take(self, waiting):
+        # Removes up to max_batch items from waiting, one per client in turn
+        if len(waiting) <= self.max_batch:
+            batch = waiting[:]
+            del waiting[:]
+            return batch
+        turns = {}
+        ranks = []
+        for i, (_, _, _, client, _) in enumerate(waiting):
+            turns[client] = turns.get(client, 0) + 1
+            ranks.append((turns[client], i))
+        chosen = {i for _, i in sorted(ranks)[:self.max_batch]}
+        batch = [waiting[i] for i in sorted(chosen)]
+        waiting[:] = [entry for i, entry in enumerate(waiting) if i not in chosen]
+        return batch
+
+    def _dispatch(self, pending_key, batch):
+        key, priority = pending_key
+        clients = {client for _, _, _, client, _ in batch}
+        # A batch shared by several clients is queued as nobody's
+        client = clients.pop() if len(clients) == 1 else None
+        try:
+            self.pool.submit(self._run, key, batch, priority=priority, client=client,
+                             cost=sum(cost for _, _, _, _, cost in batch))
+        except QueueFullError as e:
+            for future, _, _, _, _ in batch:
+                future.set_exception(e)
+
+    def _run(self, key, batch):
+        futures = [future for future, _, _, _, _ in batch]
+        with self.lock:
+            self.batches += 1
+            self.batched_items += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+        try:
+            results = self.run_batch(key, [item for _, item, _, _, _ in batch])
+        except BaseException as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
@@ -0,0 +1,395 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+# Load test for the /whisperaudio server. Generates synthetic 16 kHz WAV files,
+# posts them with a number of concurrent clients and reports latency percentiles,
+# real-time factor, throughput, peak memory and the decode / inference split.
+#
+#   python benchmark.py                                    # in-process fake engine
+#   python benchmark.py --engine faster-whisper --device cpu --compute-type int8
+#   python benchmark.py --url http://192.168.1.195:8000    # a running server
+#   python benchmark.py --url https://... --keep-alive      # handshake time saved
+#   python benchmark.py --engine faster-whisper --profiles --write-config server.json
+#                                                          # fastest hardware profile here
+#   python benchmark.py --vad-check                        # speech kept by the VAD in noise
+
+import argparse
+import http.client
+import io
+import json
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+BOUNDARY = "aiscribebenchmarkboundary"
+
+
+def synthetic_speech(seconds, speech_ratio, seed, snr_db=None, mask=None):
+    # Voiced "syllables" (harmonics of a gliding pitch with 4 Hz amplitude
+    # modulation) separated by pauses, over low background noise, or over noise
+    # snr_db below the speech like a fan in the room. mask, a boolean array of
+    # the same length, is set where there is speech.
+    rng = np.random.default_rng(seed)
+    total = int(seconds * SAMPLE_RATE)
+    audio = np.zeros(total, dtype=np.float32)
+    position = 0
+    while position < total:
+        talk = int(rng.uniform(1.0, 4.0) * SAMPLE_RATE)
+        end = min(position + talk, total)
+        t = np.arange(end - position) / SAMPLE_RATE
+        pitch = rng.uniform(110, 220) * (1 + 0.1 * np.sin(2 * np.pi * 0.5 * t))
+        phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+        voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+        envelope = 0.5 * (1 + np.sin(2 * np.pi * 4 * t)) * 0.2
+        audio[position:end] += (voice * envelope).astype(np.float32)
+        if mask is not None:
+            mask[position:end] = True
+        pause = talk * (1 - speech_ratio) / max(speech_ratio, 0.01)
+        position = end + int(pause)
+    if snr_db is None:
+        noise = 0.002
+    else:
+        spoken = audio[audio != 0]
+        noise = np.sqrt(np.mean(spoken * spoken) / 10 ** (snr_db / 10)) if len(spoken) else 0.002
+    audio += rng.normal(0, noise, total).astype(np.float32)
+    return np.clip(audio, -1, 1)
+
+
+def to_wav(audio):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(SAMPLE_RATE)
+        wf.writeframes((audio * 32767).astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+
+def generate_corpus(lengths, speech_ratios, corpus_dir=None):
+    corpus = []
+    for length in lengths:
+        for ratio in speech_ratios:
+            name = f"synthetic_{length:g}s_{int(ratio * 100)}pct_speech.wav"
+            data = to_wav(synthetic_speech(length, ratio, seed=len(corpus)))
+            corpus.append({"name": name, "data": data, "seconds": length})
+            if corpus_dir:
+                os.makedirs(corpus_dir, exist_ok=True)
+                with open(os.path.join(corpus_dir, name), 'wb') as f:
+                    f.write(data)
+    return corpus
+
+
+def unique_copy(data, index):
+    # Changes the last sample slightly so the server's result cache cannot answer
+    data = bytearray(data)
+    data[-2:] = (index % 32768).to_bytes(2, 'little')
+    return bytes(data)
+
+
+def multipart_body(data):
+    head = (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"audio\"; "
+            f"filename=\"benchmark.wav\"\r\nContent-Type: audio/wav\r\n\r\n").encode()
+    return head + data + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+class LoadClient:
+    # HTTP connections for the load threads, one per thread with keep-alive or a
+    # new one per request without. Connection setup (TCP and, for https, TLS) is
+    # timed so the report shows what persistent connections save.
+    def __init__(self, url, keep_alive=False, insecure=False):
+        self.url = url
+        self.keep_alive = keep_alive
+        self.context = ssl._create_unverified_context() if insecure else None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.connect_seconds = 0.0
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.url.scheme == "https":
+                connection = http.client.HTTPSConnection(self.url.hostname, self.url.port or 443, timeout=3600,
+                                                         context=self.context)
+            else:
+                connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=3600)
+            self.local.connection = connection
+        if connection.sock is None:
+            start = time.time()
+            connection.connect()
+            with self.lock:
+                self.connections += 1
+                self.connect_seconds += time.time() - start
+        return connection
+
+    def request(self, method, path, body=None):
+        headers = {}
+        if body is not None:
+            headers['Content-Type'] = f"multipart/form-data; boundary={BOUNDARY}"
+        for _ in range(2):
+            reused = getattr(self.local, "connection", None) is not None and self.local.connection.sock is not None
+            connection = self._connection()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                payload = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # The server closed an idle connection, retry once on a new one
+                connection.close()
+                if not reused:
+                    raise
+                continue
+            if not self.keep_alive or response.will_close:
+                connection.close()
+            return response.status, payload
+
+    def stats(self, requests_count):
+        average = self.connect_seconds / self.connections if self.connections else 0.0
+        return {
+            "keep_alive": self.keep_alive,
+            "connections_opened": self.connections,
+            "connect_seconds_average": average,
+            # Handshakes the reused connections did not have to do
+            "estimated_handshake_seconds_saved": average * max(0, requests_count - self.connections),
+        }
+
+
+def get_status(client):
+    status, payload = client.request("GET", "/status")
+    return json.loads(payload) if status == 200 else {}
+
+
+def percentile(values, pct):
+    return float(np.percentile(values, pct)) if values else 0.0
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_load(client, corpus, requests_count, concurrency, allow_cache):
+    results = []
+    lock = threading.Lock()
+
+    def one(index):
+        item = corpus[index % len(corpus)]
+        data = item["data"] if allow_cache else unique_copy(item["data"], index)
+        start = time.time()
+        status, _ = client.request("POST", "/whisperaudio", multipart_body(data))
+        with lock:
+            results.append({"status": status, "latency": time.time() - start, "seconds": item["seconds"]})
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests_count)))
+    return results, time.time() - start
+
+
+def decode_seconds(status):
+    decode = status.get("decode", {})
+    return sum(decode[path]["seconds"] for path in ("wav", "soundfile", "ffmpeg") if path in decode)
+
+
+def summarize(results, wall_time, before, after):
+    ok = [r for r in results if r["status"] == 200]
+    latencies = [r["latency"] for r in ok]
+    audio_seconds = sum(r["seconds"] for r in ok)
+    decode_before = decode_seconds(before)
+    decode_after = decode_seconds(after)
+    inference_before = before.get("average_run", 0.0) * before.get("completed", 0)
+    inference_after = after.get("average_run", 0.0) * after.get("completed", 0)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "rejected": sum(1 for r in results if r["status"] == 503),
+        "failed": sum(1 for r in results if r["status"] not in (200, 503)),
+        "wall_seconds": wall_time,
+        "audio_seconds": audio_seconds,
+        "throughput_requests_per_second": len(ok) / wall_time if wall_time else 0.0,
+        "throughput_audio_seconds_per_second": audio_seconds / wall_time if wall_time else 0.0,
+        # Wall time per second of audio across the whole run, below 1 is faster than real time
+        "real_time_factor": wall_time / audio_seconds if audio_seconds else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "decode_seconds": decode_after - decode_before,
+        "inference_seconds": inference_after - inference_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def start_local_server(args):
+    # The server runs in this process, so peak RSS includes the load generator
+    import server
+    settings = dict(server.default_settings, engine=args.engine, port=0)
+    for key in ("model", "device", "compute_type"):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    if args.profile is not None:
+        settings["hardware_profile"] = args.profile
+    if args.engine == "fake":
+        settings["decode_options"] = {"segment_seconds": 5.0, "seconds_per_audio_second": args.fake_speed}
+    settings["max_queued_requests"] = max(settings["max_queued_requests"], args.concurrency)
+    settings["long_audio_processes"] = args.long_audio_processes
+
+    class QuietRequestHandler(server.RequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    httpd = server.WhisperServer(('127.0.0.1', 0), QuietRequestHandler, settings)
+    httpd.warm_up()
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, urlparse(f"http://127.0.0.1:{httpd.server_address[1]}")
+
+
+def vad_check(snrs, speech_ratios, seconds=60.0):
+    # Share of the speech the server's VAD keeps at each signal-to-noise ratio;
+    # anything well below 1.0 is speech the model never hears
+    from vad import EnergyVAD
+    import server
+    voice_activity = EnergyVAD(threshold_db=server.default_settings["vad_threshold_db"])
+    for snr in snrs:
+        for ratio in speech_ratios:
+            mask = np.zeros(int(seconds * SAMPLE_RATE), dtype=bool)
+            audio = synthetic_speech(seconds, ratio, seed=int(snr * 10), snr_db=snr, mask=mask)
+            compressed, speech_map = voice_activity.compress(audio)
+            kept = np.zeros(len(audio), dtype=bool)
+            for _, original_start, length in speech_map.spans:
+                kept[original_start:original_start + length] = True
+            speech_kept = (kept & mask).sum() / max(mask.sum(), 1)
+            print(f"snr {snr:5.1f} dB  speech {ratio:4.0%}  speech kept {speech_kept:6.1%}  "
+                  f"audio sent {len(compressed) / len(audio):6.1%}")
+
+
+def compare_profiles(args):
+    # Benchmarks every hardware profile this machine can run, each in a fresh
+    # process so one profile's model memory does not slow down the next
+    from engines import ENGINES
+    from hardware import detect_hardware, candidate_profiles
+    hardware = detect_hardware()
+    print(f"Hardware: {hardware}")
+    reports = {}
+    for name in candidate_profiles(hardware, ENGINES[args.engine], args.device):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, "report.json")
+            command = [sys.executable, os.path.abspath(__file__), "--engine", args.engine, "--profile", name,
+                       "--fake-speed", str(args.fake_speed), "--lengths", args.lengths,
+                       "--speech-ratios", args.speech_ratios, "--requests", str(args.requests),
+                       "--concurrency", str(args.concurrency), "--output", output]
+            if args.model:
+                command += ["--model", args.model]
+            print(f"Profile {name}...")
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0 or not os.path.exists(output):
+                print(f"  failed: {(result.stderr.strip().splitlines() or ['no output'])[-1]}")
+                continue
+            with open(output, 'r') as f:
+                reports[name] = json.load(f)
+        report = reports[name]
+        print(f"  {report['throughput_audio_seconds_per_second']:.1f} audio s/s, p95 {report['latency_p95']:.2f}s, "
+              f"{report['failed'] + report['rejected']} failed")
+    usable = {name: report for name, report in reports.items() if report["succeeded"] == report["requests"]}
+    if not usable:
+        print("No profile completed every request")
+        return None
+    best = max(usable, key=lambda name: usable[name]["throughput_audio_seconds_per_second"])
+    print(f"Fastest profile: {best}")
+    if args.write_config:
+        # Kept next to whatever else the server config already holds
+        config = {}
+        if os.path.exists(args.write_config):
+            with open(args.write_config, 'r') as f:
+                config = json.load(f)
+        config["hardware_profile"] = best
+        with open(args.write_config, 'w') as f:
+            json.dump(config, f, indent=2)
+        print(f"Wrote hardware_profile {best} to {args.write_config}, start the server with --config {args.write_config}")
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the AI-Scribe transcription server")
+    parser.add_argument("--url", help="benchmark a running server instead of an in-process one")
+    parser.add_argument("--engine", default="fake")
+    parser.add_argument("--model")
+    parser.add_argument("--device")
+    parser.add_argument("--compute-type", dest="compute_type")
+    parser.add_argument("--profile", help="hardware profile of the in-process server (see hardware.PROFILES)")
+    parser.add_argument("--profiles", action="store_true", help="benchmark every hardware profile this machine can run")
+    parser.add_argument("--write-config", help="with --profiles, store the fastest profile in this server config file")
+    parser.add_argument("--fake-speed", type=float, default=0.05,
+                        help="seconds the fake engine spends per second of audio")
+    parser.add_argument("--long-audio-processes", type=int, default=0,
+                        help="transcribe long files in chunks across this many processes")
+    parser.add_argument("--lengths", default="10,60,300", help="comma separated file lengths in seconds")
+    parser.add_argument("--speech-ratios", default="0.8,0.2",
+                        help="comma separated share of speech per file, low values are clinic-like silence")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--allow-cache", action="store_true", help="send identical files so the result cache can answer")
+    parser.add_argument("--keep-alive", action="store_true", help="reuse one connection per client thread")
+    parser.add_argument("--insecure", action="store_true", help="accept self-signed certificates for https URLs")
+    parser.add_argument("--corpus-dir", help="also write the generated WAV files here")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument("--vad-check", action="store_true",
+                        help="report how much speech the VAD keeps under background noise, then exit")
+    parser.add_argument("--snrs", default="20,10,8,5,0", help="comma separated signal-to-noise ratios for --vad-check")
+    args = parser.parse_args(argv)
+    if args.vad_check:
+        vad_check([float(x) for x in args.snrs.split(",")], [float(x) for x in args.speech_ratios.split(",")])
+        return
+    if args.profiles:
+        if args.url:
+            parser.error("--profiles starts its own servers, it cannot be used with --url")
+        compare_profiles(args)
+        return
+
+    corpus = generate_corpus([float(x) for x in args.lengths.split(",")],
+                             [float(x) for x in args.speech_ratios.split(",")], args.corpus_dir)
+    if args.url:
+        httpd, url = None, urlparse(args.url)
+    else:
+        httpd, url = start_local_server(args)
+
+    client = LoadClient(url, args.keep_alive, args.insecure)
+    # Separate client so status calls do not count as load connections
+    status_client = LoadClient(url, insecure=args.insecure)
+    before = get_status(status_client)
+    results, wall_time = run_load(client, corpus, args.requests, args.concurrency, args.allow_cache)
+    report = summarize(results, wall_time, before, get_status(status_client))
+    report.update(client.stats(args.requests))
+    report["engine"] = args.engine if httpd else before.get("engine")
+    report["concurrency"] = args.concurrency
+    if httpd is None:
+        # Memory of a remote server is not visible from here
+        report["peak_rss_mb"] = None
+    else:
+        httpd.shutdown()
+        if httpd.chunker is not None:
+            httpd.chunker.shutdown()
+
+    for key, value in report.items():
+        print(f"{key:40} {value:.3f}" if isinstance(value, float) else f"{key:40} {value}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
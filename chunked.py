@@ -0,0 +1,138 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from audio_decode import SAMPLE_RATE
+from engines import create_engine
+
+# State of a worker process: its own engine and the one model it keeps loaded
+_worker = {}
+
+
+def split_at_silence(audio, voice_activity, chunk_seconds=60.0, search_seconds=10.0, sample_rate=SAMPLE_RATE):
+    # Returns (start, end) sample ranges of about chunk_seconds each. Every cut is
+    # placed in the middle of the longest pause within search_seconds of the
+    # target, or at the quietest frame when someone talks straight through.
+    frame = voice_activity.frame
+    chunk = max(int(chunk_seconds * sample_rate), 2 * frame)
+    # Searching at most half a chunk either side keeps every cut after the last one
+    search = max(min(int(search_seconds * sample_rate), chunk // 2), frame)
+    if len(audio) <= chunk + search:
+        return [(0, len(audio))]
+    speech = voice_activity.speech_frames(audio)
+
+    bounds = [0]
+    while len(audio) - bounds[-1] > chunk + search:
+        target = bounds[-1] + chunk
+        low = (target - search) // frame
+        high = min((target + search) // frame, len(speech))
+        window = speech[low:high]
+        edges = np.flatnonzero(np.diff(np.concatenate([[True], window, [True]]).astype(np.int8)))
+        pauses = edges.reshape(-1, 2)
+        if len(pauses):
+            start, end = pauses[np.argmax(pauses[:, 1] - pauses[:, 0])]
+            cut = (start + end) // 2
+        else:
+            frames = audio[low * frame:high * frame].reshape(-1, frame)
+            cut = int(np.argmin(np.mean(frames * frames, axis=1)))
+        bounds.append((low + int(cut)) * frame)
+    bounds.append(len(audio))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _init_worker(engine_name, engine_options, model_name, threads):
+    # Runs in each new process before the inference library is imported, so the
+    # thread limit applies to torch / CTranslate2
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    engine = create_engine(engine_name, **engine_options)
+    _worker["engine"] = engine
+    _worker["models"] = {model_name: engine.load_model(model_name)}
+
+
+def _transcribe_chunk(model_name, audio, offset):
+    engine = _worker["engine"]
+    models = _worker["models"]
+    if model_name not in models:
+        # One model per process, memory already scales with the process count
+        models.clear()
+        models[model_name] = engine.load_model(model_name)
+    segments, _ = engine.iter_segments(models[model_name], audio)
+    return [dict(segment, start=segment["start"] + offset, end=segment["end"] + offset) for segment in segments]
+
+
+class ChunkedTranscriber:
+    # Transcribes long recordings in parallel: the audio is split at pauses and
+    # the chunks go to a pool of processes that each hold their own model, e.g.
+    # faster-whisper with device "cpu" and compute type "int8". Segments are
+    # returned in order with timestamps relative to the whole recording.
+    def __init__(self, engine, default_model, processes, voice_activity, chunk_seconds=60.0, min_seconds=300.0):
+        self.engine = engine
+        self.default_model = default_model
+        self.processes = processes
+        self.voice_activity = voice_activity
+        self.chunk_seconds = chunk_seconds
+        self.min_seconds = min_seconds
+        self.executor = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.chunks = 0
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                threads = max(1, (os.cpu_count() or 1) // self.processes)
+                options = {"device": self.engine.device, "compute_type": self.engine.compute_type,
+                           "batch_size": self.engine.batch_size, "decode_options": self.engine.decode_options,
+                           "cpu_threads": threads, "num_workers": 1}
+                # Spawned rather than forked, CUDA and OpenMP do not survive a fork
+                self.executor = ProcessPoolExecutor(self.processes, multiprocessing.get_context("spawn"), _init_worker,
+                                                    (self.engine.name, options, self.default_model, threads))
+            return self.executor
+
+    def should_chunk(self, audio):
+        return len(audio) >= self.min_seconds * SAMPLE_RATE
+
+    def warm_up(self, audio):
+        # One job per process, so every worker starts and loads its model now
+        executor = self._executor()
+        jobs = [executor.submit(_transcribe_chunk, self.default_model, audio, 0.0) for _ in range(self.processes)]
+        for job in jobs:
+            job.result()
+
+    def transcribe_segments(self, model_name, audio, emit):
+        ranges = split_at_silence(audio, self.voice_activity, self.chunk_seconds)
+        executor = self._executor()
+        jobs = [executor.submit(_transcribe_chunk, model_name, audio[start:end], start / SAMPLE_RATE)
+                for start, end in ranges]
+        with self.lock:
+            self.requests += 1
+            self.chunks += len(jobs)
+        try:
+            for job in jobs:
+                for segment in job.result():
+                    if not emit(segment):
+                        return
+        finally:
+            for job in jobs:
+                job.cancel()
+
+    def transcribe(self, model_name, audio):
+        segments = []
+        self.transcribe_segments(model_name, audio, lambda segment: segments.append(segment) or True)
+        return self.engine.join_text(segments)
+
+    def stats(self):
+        with self.lock:
+            return {"processes": self.processes, "requests": self.requests, "chunks": self.chunks}
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
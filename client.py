@@ -5,6 +5,8 @@
 import tkinter as tk
 from tkinter import scrolledtext, ttk, filedialog
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pyperclip
 import wave
 import threading
@@ -15,14 +17,19 @@ import pyaudio
 import tkinter.messagebox as messagebox
 import datetime
 import functools
+import gc
 import os
 import whisper
+import torch
 from openai import OpenAI
 import scrubadub
 import re
 import speech_recognition as sr # python package is named speechrecognition
 import time
 import queue
+import io
+import subprocess
+from vad import EnergyVAD
 
 # Add these near the top of your script
 editable_settings = {
@@ -47,7 +54,13 @@ editable_settings = {
     "frmtrmblln": False,
     "Local Whisper": False,
     "Whisper Model": "small.en",
-    "Real Time": False
+    "Draft Whisper Model": "",
+    "Real Time": False,
+    "Stream Transcription": False,
+    "Realtime Session": False,
+    "Transcription Jobs": False,
+    "Upload Format": "wav",
+    "Server Token": ""
 }
 
                                         
@@ -145,11 +158,41 @@ use_aiscribe = True
 is_gpt_button_active = False
 p = pyaudio.PyAudio()
 audio_queue = queue.Queue()
+# Set while no realtime_text loop is still working through a recording
+realtime_finished = threading.Event()
+realtime_finished.set()
+# Two pass realtime: windows of (draft tag, audio) for the accurate model, the
+# thread working through them and what went wrong in the current recording
+accurate_queue = queue.Queue()
+accurate_thread = None
+accurate_errors = []
+ACCURATE_WINDOW_SECONDS = 30
 CHUNK = 1024
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 16000
 editable_settings_entries = {}
+voice_activity = EnergyVAD()
+# (connect, read) timeouts for the Whisper and KoboldCpp servers, reads cover a
+# whole transcription or note generation. A whole visit on a CPU server can take
+# longer than any fixed limit, so uploads of a full recording wait as long as the
+# server works on them ("Transcription Jobs" also survive a dropped connection).
+WHISPER_TIMEOUT = (10, 900)
+UPLOAD_TIMEOUT = (10, None)
+KOBOLD_TIMEOUT = (10, 600)
+# Transcription jobs: (connect, read) timeout per request, seconds between polls and
+# the file remembering a submitted job so it can be collected after a restart
+JOB_TIMEOUT = (10, 120)
+JOB_POLL_SECONDS = 2
+# Longest Retry-After wait (seconds) before a busy Whisper or KoboldCpp server is asked again
+MAX_RETRY_AFTER = 10
+PENDING_JOB_FILE = 'pending_job.txt'
+# "Upload Format" codecs: ffmpeg output options, file extension and content type.
+# Opus at 24 kbit/s is about 10x smaller than 16-bit WAV, FLAC is lossless and about 2x.
+UPLOAD_FORMATS = {
+    "flac": (["-c:a", "flac", "-f", "flac"], "flac", "audio/flac"),
+    "opus": (["-c:a", "libopus", "-b:a", "24k", "-application", "voip", "-f", "ogg"], "ogg", "audio/ogg"),
+}
 
                                                 
 def get_prompt(formatted_message):
@@ -225,54 +268,392 @@ def record_audio():
                 last_chunk_time = time.time()
     stream.stop_stream()
     stream.close()
+    if current_chunk and str(editable_settings["Real Time"]) == "True":
+        # The last words of the visit, shorter than a full chunk
+        audio_queue.put(b''.join(current_chunk))
     audio_queue.put(None) 
 
+def pcm_to_wav(audio_data):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wf:
+        wf.setnchannels(CHANNELS)
+        wf.setsampwidth(p.get_sample_size(FORMAT))
+        wf.setframerate(RATE)
+        wf.writeframes(audio_data)
+    return buffer.getvalue()
+
+class WhisperServerAuth(requests.auth.AuthBase):
+    # Identifies this workstation to the Whisper server with its "Server Token",
+    # so the server can share its time fairly between workstations. Other servers
+    # never see the token.
+    def __call__(self, request):
+        token = str(editable_settings["Server Token"]).strip()
+        if token and request.url.startswith(WHISPERAUDIO):
+            request.headers['Authorization'] = 'Bearer ' + token
+        return request
+
+class ServerRetry(Retry):
+    # 429 and 503 come before the server starts any work and are retried for any
+    # method; after 502 or 504 an upstream may already be working on the request,
+    # so only idempotent methods are sent again. A long Retry-After (the server's
+    # queue or budget estimate can be minutes) is cut to MAX_RETRY_AFTER.
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code in (502, 504) and method.upper() not in Retry.DEFAULT_ALLOWED_METHODS:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, MAX_RETRY_AFTER)
+
+def create_http_session(status_retries=True):
+    # One pooled session for all server calls, so connections (and TLS handshakes)
+    # are reused between requests. Failed connects are retried with backoff, and
+    # with status_retries the answers ServerRetry allows; a request the server may
+    # have started on is not sent twice.
+    session = requests.Session()
+    retries = ServerRetry(total=3, connect=3, read=0, status=3 if status_retries else 0, backoff_factor=0.5,
+                          status_forcelist=(429, 502, 503, 504) if status_retries else (), allowed_methods=None,
+                          raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retries, pool_maxsize=4)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.auth = WhisperServerAuth()
+    return session
+
+http_session = create_http_session()
+# Realtime chunks are not retried on busy answers: a chunk sent again after a
+# wait is stale, and the wait would hold up the recording loop
+realtime_http_session = create_http_session(status_retries=False)
+
+class LocalWhisperModels:
+    # Keeps "Local Whisper" models loaded between recordings. load() starts
+    # loading a model on a background thread, get() waits for it (loading it
+    # first if nobody asked yet) and keep() frees the models no longer set.
+    # on_change is called from the loading thread whenever a state changes.
+    def __init__(self):
+        self.models = {}
+        self.loading = {}
+        self.states = {}
+        self.lock = threading.Lock()
+        self.on_change = None
+
+    def load(self, name):
+        with self.lock:
+            if name in self.models or name in self.loading:
+                return
+            done = self.loading[name] = threading.Event()
+            self.states[name] = "loading"
+        self._changed()
+        threading.Thread(target=self._load, args=(name, done), daemon=True).start()
+
+    def _load(self, name, done):
+        start = time.time()
+        try:
+            model = whisper.load_model(name)
+        except Exception as e:
+            print(f"Loading Whisper model {name} failed: {e}")
+            model = None
+        else:
+            print(f"Loaded Whisper model {name} in {time.time() - start:.1f}s")
+        with self.lock:
+            del self.loading[name]
+            if model is not None:
+                self.models[name] = model
+            self.states[name] = "ready" if model is not None else "failed"
+        done.set()
+        self._changed()
+
+    def get(self, name):
+        self.load(name)
+        with self.lock:
+            done = self.loading.get(name)
+        if done is not None:
+            done.wait()
+        with self.lock:
+            model = self.models.get(name)
+        if model is None:
+            raise RuntimeError(f"Whisper model {name} could not be loaded")
+        return model
+
+    def keep(self, names):
+        with self.lock:
+            unloaded = [name for name in self.models if name not in names]
+            for name in unloaded:
+                del self.models[name]
+            for name in list(self.states):
+                if name not in names and name not in self.loading:
+                    del self.states[name]
+        if unloaded:
+            print(f"Unloaded Whisper model {', '.join(unloaded)}")
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        self._changed()
+
+    def status(self):
+        with self.lock:
+            return dict(self.states)
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+local_models = LocalWhisperModels()
+
+def local_model_names():
+    # Models the current settings transcribe with locally
+    if editable_settings["Local Whisper"] != "True":
+        return []
+    names = [editable_settings["Whisper Model"].strip()]
+    if two_pass_enabled():
+        names.append(str(editable_settings["Draft Whisper Model"]).strip())
+    return names
+
+def preload_local_models():
+    # Loads the models for the current settings before the first recording and
+    # frees the ones they no longer use
+    names = local_model_names()
+    local_models.keep(names)
+    for name in names:
+        local_models.load(name)
+
+def update_model_status():
+    status = local_models.status()
+    text = ", ".join(f"{name} {state}" for name, state in status.items())
+    model_status_label.config(text=f"Whisper: {text}" if text else "")
+
+def encode_for_upload(audio_data, name):
+    # Compresses recorded WAV audio before it goes over the network; other files
+    # and failed encodes are sent unchanged
+    upload_format = str(editable_settings["Upload Format"]).strip().lower()
+    if upload_format not in UPLOAD_FORMATS or not audio_data.startswith(b"RIFF"):
+        return (name, audio_data)
+    options, extension, content_type = UPLOAD_FORMATS[upload_format]
+    start = time.time()
+    cmd = ["ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-ac", "1", "-ar", str(RATE)] + options + ["pipe:1"]
+    try:
+        encoded = subprocess.run(cmd, input=audio_data, capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Encoding as {upload_format} failed, uploading WAV: {e}")
+        return (name, audio_data)
+    print(f"Encoded {len(audio_data) / 1024:.0f} KB WAV as {upload_format}: {len(encoded) / 1024:.0f} KB "
+          f"({len(audio_data) / max(len(encoded), 1):.1f}x smaller) in {time.time() - start:.2f}s")
+    return (os.path.splitext(name)[0] + "." + extension, encoded, content_type)
+
+def upload_files(file_to_send):
+    with open(file_to_send, 'rb') as f:
+        return {'audio': encode_for_upload(f.read(), os.path.basename(file_to_send))}
+
+def realtime_session_request(method, path="", **kwargs):
+    url = WHISPERAUDIO + "/session" + path
+    if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1":
+        kwargs["verify"] = False
+    try:
+        response = realtime_http_session.request(method, url, timeout=WHISPER_TIMEOUT, **kwargs)
+    except requests.exceptions.RequestException as e:
+        show_error(f"Realtime transcription failed: {e}", finished=False)
+        return None
+    if response.status_code == 200:
+        return response.json()
+    show_error(f"Realtime transcription failed: the server answered {response.status_code}", finished=False)
+    return None
+
+# The server keeps the audio tail and previous text of a session, so chunks are
+# decoded with context and only the new text comes back
+def open_realtime_session():
+    result = realtime_session_request("POST")
+    return result["session"] if result else None
+
+def send_realtime_chunk(session_id, audio_data):
+    files = {'audio': encode_for_upload(pcm_to_wav(audio_data), 'chunk.wav')}
+    result = realtime_session_request("POST", "/" + session_id, files=files)
+    return result["text"] if result else ""
+
+def close_realtime_session(session_id):
+    result = realtime_session_request("DELETE", "/" + session_id)
+    return result["text"] if result else ""
+
+def two_pass_enabled():
+    # A "Draft Whisper Model" shows quick draft text while recording, which the
+    # "Whisper Model" then replaces window by window
+    return editable_settings["Real Time"] == "True" and bool(str(editable_settings["Draft Whisper Model"]).strip())
+
+def transcribe_pcm(audio_data, model_name, model, priority):
+    # Text of 16-bit PCM audio from a loaded local model, or from the server when
+    # model is None, with the server's default model when model_name is None.
+    # Raises RuntimeError when the server fails.
+    if model is not None:
+        audio_buffer = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768
+        return model.transcribe(audio_buffer, fp16=False)['text']
+    files = {'audio': encode_for_upload(pcm_to_wav(audio_data), 'chunk.wav')}
+    data = {'model': model_name} if model_name else {}
+    kwargs = {"verify": False} if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1" else {}
+    session = realtime_http_session if priority == 'realtime' else http_session
+    description = model_name or "the server's model"
+    try:
+        response = session.post(WHISPERAUDIO, files=files, data=data,
+                                headers={'X-Priority': priority}, timeout=WHISPER_TIMEOUT, **kwargs)
+    except requests.exceptions.RequestException as e:
+        raise RuntimeError(f"transcription with {description} failed: {e}")
+    if response.status_code != 200:
+        raise RuntimeError(f"the server could not transcribe with {description} ({response.status_code})")
+    return response.json()['text']
+
+def accurate_pass(model_name, errors):
+    # Re-transcribes each finished window with the accurate model and puts the
+    # text in place of its draft, until realtime_text sends None. Windows that
+    # fail keep their gray draft text and add to errors.
+    model = None
+    load_error = None
+    if editable_settings["Local Whisper"] == "True":
+        try:
+            model = local_models.get(model_name)
+        except Exception as e:
+            load_error = str(e)
+    while True:
+        window = accurate_queue.get()
+        if window is None:
+            break
+        tag, audio_data = window
+        try:
+            if load_error is not None:
+                raise RuntimeError(load_error)
+            text = transcribe_pcm(audio_data, model_name, model, 'interactive')
+        except Exception as e:
+            print(f"Accurate pass failed, keeping the draft of {tag}: {e}")
+            errors.append(str(e))
+            user_input.tag_delete(tag)
+            continue
+        replace_draft(tag, text)
+
+def replace_draft(tag, text):
+    ranges = user_input.tag_ranges(tag)
+    user_input.tag_delete(tag)
+    if not ranges:
+        # Cleared while the accurate pass ran
+        return
+    user_input.delete(ranges[0], ranges[-1])
+    # An explicit empty tag list, so the text does not take the draft tag of its neighbours
+    user_input.insert(ranges[0], text + '\n', ())
+
 def realtime_text():
-    global frames, is_realtimeactive
+    global is_realtimeactive, accurate_thread, accurate_errors
     if not is_realtimeactive:
         is_realtimeactive = True
+        realtime_finished.clear()
         model_name = editable_settings["Whisper Model"].strip()
-        model = whisper.load_model(model_name)    
-        while True:
-            audio_data = audio_queue.get()
-            if audio_data is None:
-                break        
-            if editable_settings["Real Time"]:
-                print("Real Time Audio to Text")
-                audio_buffer = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768
-                if editable_settings["Local Whisper"] == "True":
-                    print("Local Real Time Whisper")
-                    result = model.transcribe(audio_buffer, fp16=False)
-                    update_gui(result['text'])
-                else:
-                    print("Remote Real Time Whisper")
-                    if frames:
-                        with wave.open('realtime.wav', 'wb') as wf:
-                            wf.setnchannels(CHANNELS)
-                            wf.setsampwidth(p.get_sample_size(FORMAT))
-                            wf.setframerate(RATE)
-                            wf.writeframes(b''.join(frames))
-                        frames = []
-                    file_to_send = 'realtime.wav'
-                    with open(file_to_send, 'rb') as f:
-                        files = {'audio': f}
-                        if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1":
-                                response = requests.post(WHISPERAUDIO, files=files, verify=False)
-                        else:
-                                response = requests.post(WHISPERAUDIO, files=files)                
-                        if response.status_code == 200:
+        two_pass = two_pass_enabled()
+        draft_model_name = str(editable_settings["Draft Whisper Model"]).strip()
+        session_id = None
+        stopped = False
+        finished = False
+        if two_pass:
+            accurate_errors = []
+            # "Whisper Model" names a local model, on the server the accurate pass
+            # uses its default model like whole recordings do
+            accurate_model_name = model_name if editable_settings["Local Whisper"] == "True" else None
+            thread = threading.Thread(target=accurate_pass, args=(accurate_model_name, accurate_errors), daemon=True)
+            thread.start()
+            accurate_thread = thread
+            window = 0
+            window_audio = []
+        # The accurate pass always gets its None, or the note would wait for it forever
+        try:
+            model = None
+            if editable_settings["Local Whisper"] == "True":
+                model = local_models.get(draft_model_name if two_pass else model_name)
+            if not two_pass and editable_settings["Real Time"] and editable_settings["Local Whisper"] != "True" and str(editable_settings["Realtime Session"]) == "True":
+                session_id = open_realtime_session()
+            while True:
+                audio_data = audio_queue.get()
+                if audio_data is None:
+                    stopped = True
+                    if two_pass and window_audio:
+                        accurate_queue.put((f"draft-{window}", b''.join(window_audio)))
+                    if session_id:
+                        text = close_realtime_session(session_id)
+                        if text:
+                            update_gui(text)
+                    break        
+                if editable_settings["Real Time"]:
+                    print("Real Time Audio to Text")
+                    audio_buffer = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768
+                    if two_pass:
+                        print("Two Pass Real Time Whisper")
+                        if voice_activity.has_speech(audio_buffer):
+                            try:
+                                text = transcribe_pcm(audio_data, draft_model_name, model, 'realtime')
+                            except Exception as e:
+                                # The accurate pass still covers this chunk, keep listening
+                                show_error(f"Draft transcription failed: {e}", finished=False)
+                                text = ""
+                            # Even an empty draft keeps a place for the accurate text
+                            update_gui(text or "", f"draft-{window}")
+                            window_audio.append(audio_data)
+                            if sum(len(chunk) for chunk in window_audio) >= ACCURATE_WINDOW_SECONDS * RATE * 2:
+                                accurate_queue.put((f"draft-{window}", b''.join(window_audio)))
+                                window += 1
+                                window_audio = []
+                    elif editable_settings["Local Whisper"] == "True":
+                        print("Local Real Time Whisper")
+                        # Skip the model entirely for chunks without speech
+                        if voice_activity.has_speech(audio_buffer):
+                            result = model.transcribe(audio_buffer, fp16=False)
+                            update_gui(result['text'])
+                    elif session_id:
+                        print("Remote Real Time Whisper Session")
+                        text = send_realtime_chunk(session_id, audio_data)
+                        if text:
+                            update_gui(text)
+                    else:
+                        print("Remote Real Time Whisper")
+                        # Only this chunk is sent, frames stay whole for recording.wav
+                        files = {'audio': encode_for_upload(pcm_to_wav(audio_data), 'realtime.wav')}
+                        # Live chunks go ahead of uploads and queued jobs on the server
+                        headers = {'X-Priority': 'realtime'}
+                        try:
+                            if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1":
+                                    response = realtime_http_session.post(WHISPERAUDIO, files=files, headers=headers, timeout=WHISPER_TIMEOUT, verify=False)
+                            else:
+                                    response = realtime_http_session.post(WHISPERAUDIO, files=files, headers=headers, timeout=WHISPER_TIMEOUT)
+                        except requests.exceptions.RequestException as e:
+                            # The next chunk may get through, keep listening
+                            show_error(f"Realtime transcription failed: {e}", finished=False)
+                            response = None
+                        if response is not None and response.status_code == 200:
                             text = response.json()['text']
                             update_gui(text)
-                audio_queue.task_done()
+                    audio_queue.task_done()
+            finished = True
+        finally:
+            if not stopped:
+                # Leave no chunks of this recording for the next one
+                while audio_queue.get() is not None:
+                    pass
+            if two_pass:
+                if not finished:
+                    accurate_errors.append(f"the draft pass with {draft_model_name} failed")
+                accurate_queue.put(None)
+            realtime_finished.set()
     else:
         is_realtimeactive = False
 
-def update_gui(text):
-    user_input.insert(tk.END, text + '\n')
+def update_gui(text, draft_tag=None):
+    user_input.insert(tk.END, text + '\n', ("draft", draft_tag) if draft_tag else ())
     user_input.see(tk.END)
     
+def show_error(message, finished=True):
+    # finished is False for errors while still recording
+    response_display.configure(state='normal')
+    response_display.delete("1.0", tk.END)
+    response_display.insert(tk.END, message)
+    response_display.configure(state='disabled')
+    if finished:
+        stop_flashing()
+
 def save_audio():
-    global frames
+    global frames, accurate_thread
     if frames:
         with wave.open('recording.wav', 'wb') as wf:
             wf.setnchannels(CHANNELS)
@@ -281,6 +662,17 @@ def save_audio():
             wf.writeframes(b''.join(frames))
         frames = []  # Clear recorded data
         if editable_settings["Real Time"] == "True":
+            # Text still on its way, like the tail a realtime session holds
+            # back until it is closed, belongs in the note
+            realtime_finished.wait()
+            if accurate_thread is not None:
+                # The note is made from the accurate text, never the draft
+                accurate_thread.join()
+                accurate_thread = None
+                if accurate_errors:
+                    show_error(f"The accurate transcription failed ({accurate_errors[0]}), so no note was made. "
+                               "Gray text is still the draft: check it, then press AI Request to make the note.")
+                    return
             send_and_receive()
         else:
             threaded_send_audio_to_server()
@@ -348,6 +740,8 @@ def save_settings(koboldcpp_ip, whisperaudio_ip, openai_api_key, aiscribe_text,
             value = int(value)
         # Add similar conditions for other data types
         editable_settings[setting] = value 
+    # Loads a changed "Whisper Model" now instead of at the next recording
+    preload_local_models()
     save_settings_to_file(KOBOLDCPP_IP, WHISPERAUDIO_IP, OPENAI_API_KEY, KOBOLDCPP_PORT, WHISPERAUDIO_PORT, SSL_ENABLE, SSL_SELFCERT)  # Save to file
     AISCRIBE = aiscribe_text
     AISCRIBE2 = aiscribe2_text
@@ -365,11 +759,12 @@ def send_audio_to_server():
         user_input.delete("1.0", tk.END)
         user_input.insert(tk.END, "Audio to Text Processing...Please Wait")
         model_name = editable_settings["Whisper Model"].strip()
-        model = whisper.load_model(model_name)
+        model = local_models.get(model_name)
         file_to_send = uploaded_file_path if uploaded_file_path else 'recording.wav'
         uploaded_file_path = None
-        result = model.transcribe(file_to_send)
-        transcribed_text = result["text"]        
+        # Cut long silences so inference time follows the amount of speech
+        audio, _ = voice_activity.compress(whisper.load_audio(file_to_send))
+        transcribed_text = model.transcribe(audio)["text"] if len(audio) else ""
         user_input.configure(state='normal') 
         user_input.delete("1.0", tk.END)
         user_input.insert(tk.END, transcribed_text)
@@ -384,18 +779,132 @@ def send_audio_to_server():
             uploaded_file_path = None  
         else:
             file_to_send = 'recording.wav'
-        with open(file_to_send, 'rb') as f:
-            files = {'audio': f}
+        if str(editable_settings["Stream Transcription"]) == "True":
+            stream_audio_to_server(file_to_send)
+            return
+        if str(editable_settings["Transcription Jobs"]) == "True":
+            job_id = submit_transcription_job(file_to_send)
+            if job_id:
+                show_transcription_job(job_id)
+            return
+        files = upload_files(file_to_send)
+        try:
             if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1":
-                response = requests.post(WHISPERAUDIO, files=files, verify=False)
+                response = http_session.post(WHISPERAUDIO, files=files, timeout=UPLOAD_TIMEOUT, verify=False)
             else:
-                response = requests.post(WHISPERAUDIO, files=files)
-            if response.status_code == 200:
-                transcribed_text = response.json()['text']
-                user_input.configure(state='normal')
-                user_input.delete("1.0", tk.END)
-                user_input.insert(tk.END, transcribed_text)             
-                send_and_receive()
+                response = http_session.post(WHISPERAUDIO, files=files, timeout=UPLOAD_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            show_transcription_error(f"Transcription failed: {e}")
+            return
+        if response.status_code == 200:
+            transcribed_text = response.json()['text']
+            user_input.configure(state='normal')
+            user_input.delete("1.0", tk.END)
+            user_input.insert(tk.END, transcribed_text)             
+            send_and_receive()
+        else:
+            show_transcription_error(f"Transcription failed: the server answered {response.status_code}")
+
+def show_transcription_error(message):
+    # The recording stays on disk, Upload File can send it again
+    user_input.configure(state='normal')
+    user_input.delete("1.0", tk.END)
+    show_error(message)
+
+def job_request(method, path="", **kwargs):
+    url = WHISPERAUDIO + "/jobs" + path
+    if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1":
+        kwargs["verify"] = False
+    return http_session.request(method, url, timeout=JOB_TIMEOUT, **kwargs)
+
+# The server queues the upload and keeps the result, so a dropped connection while
+# waiting only delays the transcript instead of throwing the inference away
+def submit_transcription_job(file_to_send):
+    files = upload_files(file_to_send)
+    try:
+        response = job_request("POST", files=files)
+    except requests.exceptions.RequestException as e:
+        show_transcription_error(f"Transcription job could not be submitted: {e}")
+        return None
+    if response.status_code != 202:
+        show_transcription_error(f"Transcription job was not accepted: the server answered {response.status_code}")
+        return None
+    job_id = response.json()["job"]
+    with open(PENDING_JOB_FILE, 'w') as f:
+        f.write(job_id)
+    return job_id
+
+def wait_for_transcription_job(job_id):
+    while True:
+        try:
+            response = job_request("GET", "/" + job_id + "/result")
+        except requests.exceptions.RequestException as e:
+            print(f"Waiting for transcription job: {e}")
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        if response.status_code == 202:
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        if os.path.exists(PENDING_JOB_FILE):
+            os.remove(PENDING_JOB_FILE)
+        if response.status_code == 200:
+            return response.json()["text"]
+        show_transcription_error(f"Transcription job failed: the server answered {response.status_code}")
+        return None
+
+def show_transcription_job(job_id):
+    transcribed_text = wait_for_transcription_job(job_id)
+    if transcribed_text is not None:
+        user_input.configure(state='normal')
+        user_input.delete("1.0", tk.END)
+        user_input.insert(tk.END, transcribed_text)
+        send_and_receive()
+
+def resume_transcription_job():
+    # Collects a job submitted before the client was closed
+    with open(PENDING_JOB_FILE, 'r') as f:
+        job_id = f.read().strip()
+    user_input.configure(state='normal')
+    user_input.delete("1.0", tk.END)
+    user_input.insert(tk.END, "Collecting previous transcription...Please Wait")
+    show_transcription_job(job_id)
+
+def stream_audio_to_server(file_to_send):
+    # Segments arrive as JSON lines while the server is still transcribing
+    files = upload_files(file_to_send)
+    try:
+        if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1":
+            response = http_session.post(WHISPERAUDIO + "/stream", files=files, stream=True, timeout=UPLOAD_TIMEOUT,
+                                         verify=False)
+        else:
+            response = http_session.post(WHISPERAUDIO + "/stream", files=files, stream=True, timeout=UPLOAD_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        show_transcription_error(f"Transcription failed: {e}")
+        return
+    if response.status_code != 200:
+        show_transcription_error(f"Transcription failed: the server answered {response.status_code}")
+        return
+    user_input.configure(state='normal')
+    user_input.delete("1.0", tk.END)
+    # Closing the response hands the connection back to the session
+    with response:
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                segment = json.loads(line)
+                if "error" in segment:
+                    show_error(f"Transcription failed: {segment['error']}")
+                    return
+                if segment.get("done"):
+                    break
+                user_input.insert(tk.END, segment["text"])
+                user_input.see(tk.END)
+        except requests.exceptions.RequestException as e:
+            # What arrived stays in the transcript
+            show_error(f"Transcription stopped part way: {e}")
+            return
+    send_and_receive()
 
 def send_and_receive():
     global use_aiscribe, user_message
@@ -412,15 +921,21 @@ def handle_message(formatted_message):
         show_edit_transcription_popup(formatted_message)
     else:
         prompt = get_prompt(formatted_message)
-        if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1":
-            response = requests.post(f"{KOBOLDCPP}/api/v1/generate", json=prompt, verify=False)
-        else:
-            response = requests.post(f"{KOBOLDCPP}/api/v1/generate", json=prompt)
+        try:
+            if str(SSL_ENABLE) == "1" and str(SSL_SELFCERT) == "1":
+                response = http_session.post(f"{KOBOLDCPP}/api/v1/generate", json=prompt, timeout=KOBOLD_TIMEOUT, verify=False)
+            else:
+                response = http_session.post(f"{KOBOLDCPP}/api/v1/generate", json=prompt, timeout=KOBOLD_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            show_error(f"Note creation failed: {e}")
+            return
         if response.status_code == 200:
             results = response.json()['results']
             response_text = results[0]['text']
             response_text = response_text.replace("  ", " ").strip() 
             update_gui_with_response(response_text)
+        else:
+            show_error(f"Note creation failed: the server answered {response.status_code}")
 
 def clear_response_display():
     response_display.configure(state='normal')
@@ -713,6 +1228,8 @@ root.title("AI Medical Scribe")
 
 user_input = scrolledtext.ScrolledText(root, height=12)
 user_input.grid(row=0, column=0, columnspan=10, padx=5, pady=5)
+# Draft text of a two pass recording until the accurate pass replaces it
+user_input.tag_configure("draft", foreground="gray")
 
 mic_button = tk.Button(root, text="Mic OFF", command=lambda: (threaded_toggle_recording(), threaded_realtime_text()), height=2, width=10)
 mic_button.grid(row=1, column=0, pady=5)
@@ -765,12 +1282,20 @@ combobox.grid(row=3, column=3, columnspan=4, pady=10, padx=10)
 
 update_aiscribe_texts(None)
 
+model_status_label = tk.Label(root, text="", anchor='w')
+model_status_label.grid(row=3, column=0, columnspan=3, padx=5, sticky='w')
+local_models.on_change = update_model_status
+preload_local_models()
+
 # Bind Alt+P to send_and_receive function
 root.bind('<Alt-p>', lambda event: pause_button.invoke())
 
 # Bind Alt+R to toggle_recording function
 root.bind('<Alt-r>', lambda event: mic_button.invoke())
 
+if os.path.exists(PENDING_JOB_FILE):
+    threading.Thread(target=resume_transcription_job).start()
+
 root.mainloop()
 
 p.terminate()
@@ -0,0 +1,147 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import threading
+import time
+
+DEFAULT_LIMITS = {"weight": 1.0, "max_concurrent": 0, "audio_seconds_per_minute": 0}
+# Callers without a token are forgotten after this long without a request, and at
+# most this many are kept
+IDLE_CLIENT_SECONDS = 600
+MAX_UNTOKENED_CLIENTS = 1000
+
+
+class ClientLimitError(Exception):
+    # reason is "concurrency" or "budget", retry_after the seconds until it may pass
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ClientState:
+    def __init__(self, limits):
+        self.limits = limits
+        self.in_flight = 0
+        self.requests = 0
+        self.rejected = {"concurrency": 0, "budget": 0}
+        self.audio_seconds = 0.0
+        self.inference_seconds = 0.0
+        # Audio seconds that may still be sent, refilled continuously up to one minute's budget
+        self.budget = float(limits["audio_seconds_per_minute"])
+        self.refilled = time.time()
+        self.last_seen = self.refilled
+
+
+class ClientRegistry:
+    # Identifies callers and enforces their limits. Clients listed in tokens are
+    # {token: {"name": ..., "weight": ..., "max_concurrent": ..., "audio_seconds_per_minute": ...}}
+    # and send "Authorization: Bearer <token>". Other callers are named by an
+    # X-Client-Id header (only with trust_client_id, as any caller can change it)
+    # or their address and get the defaults, or are refused when require_token is
+    # set. 0 means no limit. Idle callers without a token are forgotten, so their
+    # number stays bounded. With several server processes every process enforces
+    # the limits on its own share of the requests.
+    def __init__(self, tokens=None, defaults=None, require_token=False, trust_client_id=False,
+                 idle_seconds=IDLE_CLIENT_SECONDS, max_untokened=MAX_UNTOKENED_CLIENTS):
+        self.defaults = dict(DEFAULT_LIMITS, **(defaults or {}))
+        self.tokens = {token: {**self.defaults, "name": token[:8], **config} for token, config in (tokens or {}).items()}
+        self.limits = {config["name"]: config for config in self.tokens.values()}
+        self.require_token = require_token
+        self.trust_client_id = trust_client_id
+        # Forgetting a client before its budget has refilled would reset it
+        self.idle_seconds = max(idle_seconds, 60)
+        self.max_untokened = max_untokened
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def identify(self, headers, address):
+        # Client name of a request, None when a token is required and missing
+        authorization = headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            config = self.tokens.get(authorization[len('Bearer '):].strip())
+            if config is not None:
+                return config["name"]
+        if self.require_token:
+            return None
+        if not self.trust_client_id:
+            return address[0]
+        name = headers.get('X-Client-Id', '').strip()[:64]
+        # A header cannot borrow the limits of a client with a token
+        return name if name and name not in self.limits else address[0]
+
+    def _state(self, name):
+        state = self.clients.get(name)
+        if state is None:
+            if name not in self.limits:
+                self._expire(room=1)
+            state = self.clients[name] = ClientState(self.limits.get(name, self.defaults))
+        state.last_seen = time.time()
+        return state
+
+    def _expire(self, room=0):
+        # Drops idle callers without a token, the least recently seen first while
+        # there are too many to add room more
+        now = time.time()
+        idle = sorted((state.last_seen, name) for name, state in self.clients.items()
+                      if name not in self.limits and state.in_flight == 0)
+        untokened = sum(1 for name in self.clients if name not in self.limits)
+        for last_seen, name in idle:
+            if now - last_seen < self.idle_seconds and untokened + room <= self.max_untokened:
+                break
+            del self.clients[name]
+            untokened -= 1
+
+    def weight(self, name):
+        return float(self.limits.get(name, self.defaults)["weight"]) or 1.0
+
+    def acquire(self, name):
+        # Starts a request, raises ClientLimitError when the client is at its limit
+        now = time.time()
+        with self.lock:
+            state = self._state(name)
+            limit = state.limits["max_concurrent"]
+            if limit and state.in_flight >= limit:
+                state.rejected["concurrency"] += 1
+                raise ClientLimitError("concurrency", 1)
+            per_minute = state.limits["audio_seconds_per_minute"]
+            if per_minute:
+                rate = per_minute / 60.0
+                state.budget = min(per_minute, state.budget + (now - state.refilled) * rate)
+                state.refilled = now
+                if state.budget <= 0:
+                    state.rejected["budget"] += 1
+                    raise ClientLimitError("budget", int(-state.budget / rate) + 1)
+            state.in_flight += 1
+            state.requests += 1
+
+    def release(self, name):
+        with self.lock:
+            self._state(name).in_flight -= 1
+
+    def charge(self, name, audio_seconds):
+        # A long recording may overdraw the budget, later requests wait until it refills
+        with self.lock:
+            state = self._state(name)
+            state.audio_seconds += audio_seconds
+            if state.limits["audio_seconds_per_minute"]:
+                state.budget -= audio_seconds
+
+    def record_inference(self, name, seconds):
+        with self.lock:
+            self._state(name).inference_seconds += seconds
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+            return {
+                name: {
+                    "in_flight": state.in_flight,
+                    "requests": state.requests,
+                    "rejected": dict(state.rejected),
+                    "audio_seconds": state.audio_seconds,
+                    "inference_seconds": state.inference_seconds,
+                    "weight": self.weight(name),
+                }
+                for name, state in self.clients.items()
+            }
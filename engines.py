@@ -0,0 +1,192 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import time
+
+import numpy as np
+
+from audio_decode import SAMPLE_RATE
+
+
+class Engine:
+    # Common interface of the inference back ends. Engines work on 16 kHz float32
+    # audio and return segments as {"start", "end", "text"} dicts. The inference
+    # libraries are only imported when a model is loaded, so the server runs with
+    # whichever one is installed.
+    name = None
+    default_model = "medium.en"
+    available_models = ["small.en", "medium.en"]
+    default_device = None
+    default_compute_type = None
+    # Compute types the engine can run, hardware profiles are limited to these
+    compute_types = ("float16", "int8_float16", "int8", "float32")
+    default_decode_options = {}
+    supports_batching = False
+
+    def __init__(self, device=None, compute_type=None, batch_size=16, decode_options=None, cpu_threads=0,
+                 num_workers=1):
+        self.device = device or self.default_device
+        self.compute_type = compute_type or self.default_compute_type
+        self.batch_size = batch_size
+        self.decode_options = dict(self.default_decode_options if decode_options is None else decode_options)
+        # Threads per model on CPU (0 is the library default) and how many
+        # transcriptions one loaded model may run at once
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+
+    def load_model(self, model_name):
+        raise NotImplementedError
+
+    def iter_segments(self, model, audio, prompt=None, language=None):
+        # Returns (segments iterable, detected language)
+        raise NotImplementedError
+
+    def call_options(self, **options):
+        # decode_options with the per-call values that are set, which win
+        merged = dict(self.decode_options)
+        merged.update((key, value) for key, value in options.items() if value is not None)
+        return merged
+
+    def join_text(self, segments):
+        return "".join(segment["text"] for segment in segments)
+
+    def transcribe(self, model, audio):
+        segments, _ = self.iter_segments(model, audio)
+        return self.join_text(segments)
+
+    def transcribe_window(self, model, audio, prompt, language):
+        segments, language = self.iter_segments(model, audio, prompt, language)
+        return list(segments), language
+
+    def transcribe_segments(self, model, audio, emit):
+        segments, _ = self.iter_segments(model, audio)
+        for segment in segments:
+            if not emit(segment):
+                break
+
+    def transcribe_batch(self, model, audios):
+        return [self.transcribe(model, audio) for audio in audios]
+
+
+class WhisperEngine(Engine):
+    name = "openai-whisper"
+    default_model = "medium"
+    available_models = ["small.en", "medium"]
+    compute_types = ("float16", "float32")
+
+    def load_model(self, model_name):
+        import whisper
+        if self.cpu_threads:
+            import torch
+            torch.set_num_threads(self.cpu_threads)
+        return whisper.load_model(model_name, device=self.device)
+
+    def iter_segments(self, model, audio, prompt=None, language=None):
+        # openai-whisper only returns segments once the whole file is decoded
+        options = self.call_options(initial_prompt=prompt, language=language)
+        if self.compute_type is not None:
+            options.setdefault("fp16", self.compute_type == "float16")
+        result = model.transcribe(audio, **options)
+        segments = ({"start": s["start"], "end": s["end"], "text": s["text"]} for s in result["segments"])
+        return segments, result["language"]
+
+
+class FasterWhisperEngine(Engine):
+    name = "faster-whisper"
+    default_device = "cuda"
+    default_compute_type = "float16"
+    default_decode_options = {"beam_size": 5}
+
+    def load_model(self, model_name):
+        from faster_whisper import WhisperModel
+        # e.g. compute_type "int8_float16" on GPU or device "cpu" with "int8"
+        return WhisperModel(model_name, device=self.device, compute_type=self.compute_type,
+                            cpu_threads=self.cpu_threads, num_workers=self.num_workers)
+
+    def iter_segments(self, model, audio, prompt=None, language=None):
+        # faster-whisper decodes lazily, so segments are produced one at a time
+        segments, info = model.transcribe(audio, **self.call_options(initial_prompt=prompt, language=language))
+        print("Detected language '%s' with probability %f" % (info.language, info.language_probability))
+        return ({"start": s.start, "end": s.end, "text": s.text} for s in segments), info.language
+
+
+class WhisperXEngine(Engine):
+    name = "whisperx"
+    default_device = "cuda"
+    default_compute_type = "float16"
+    supports_batching = True
+
+    def load_model(self, model_name):
+        import whisperx
+        # English-only models get a fixed tokenizer so batched clips skip language detection
+        language = "en" if model_name.endswith(".en") else None
+        options = {"threads": self.cpu_threads} if self.cpu_threads else {}
+        return whisperx.load_model(model_name, device=self.device, compute_type=self.compute_type, language=language,
+                                   **options)
+
+    def iter_segments(self, model, audio, prompt=None, language=None):
+        # WhisperX fixes the prompt when the model is loaded, only the language carries over
+        result = model.transcribe(audio, **self.call_options(batch_size=self.batch_size, language=language))
+        segments = ({"start": s["start"], "end": s["end"], "text": s["text"]} for s in result["segments"])
+        return segments, result["language"]
+
+    def join_text(self, segments):
+        return " ".join(segment["text"].strip() for segment in segments)
+
+    def transcribe_batch(self, model, audios):
+        from whisperx.audio import N_SAMPLES
+        transcriptions = [None] * len(audios)
+        # Clips that fit in one Whisper window go through the batched pipeline together,
+        # longer ones are split by VAD and batched internally by transcribe
+        short_clips = [i for i, audio in enumerate(audios) if len(audio) <= N_SAMPLES]
+        if len(short_clips) > 1 and model.tokenizer is not None:
+            inputs = ({'inputs': audios[i]} for i in short_clips)
+            for i, output in zip(short_clips, model(inputs, batch_size=self.batch_size, num_workers=0)):
+                text = output['text']
+                transcriptions[i] = text[0] if isinstance(text, list) else text
+        for i, audio in enumerate(audios):
+            if transcriptions[i] is None:
+                transcriptions[i] = self.transcribe(model, audio)
+        return transcriptions
+
+
+class FakeModel:
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+
+class FakeEngine(Engine):
+    # Deterministic stand-in for tests and benchmarks. Emits one segment per
+    # segment_seconds of audio and sleeps seconds_per_audio_second to mimic the
+    # real-time factor of a real model.
+    name = "fake"
+    default_decode_options = {"segment_seconds": 5.0, "seconds_per_audio_second": 0.0}
+    supports_batching = True
+
+    def load_model(self, model_name):
+        return FakeModel(model_name)
+
+    def iter_segments(self, model, audio, prompt=None, language=None):
+        segment_seconds = self.decode_options["segment_seconds"]
+        duration = len(audio) / SAMPLE_RATE
+
+        def segments():
+            start = 0.0
+            while start < duration:
+                end = min(start + segment_seconds, duration)
+                samples = audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)]
+                time.sleep((end - start) * self.decode_options["seconds_per_audio_second"])
+                level = int(np.sqrt(np.mean(samples * samples)) * 1000) if len(samples) else 0
+                yield {"start": start, "end": end, "text": f" {model.model_name} {start:.1f}-{end:.1f} level {level}."}
+                start = end
+
+        return segments(), language or "en"
+
+
+ENGINES = {engine.name: engine for engine in (WhisperEngine, FasterWhisperEngine, WhisperXEngine, FakeEngine)}
+
+
+def create_engine(name, **options):
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine '{name}', choose one of: {', '.join(ENGINES)}")
+    return ENGINES[name](**options)
@@ -0,0 +1,120 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import subprocess
+
+from prefork import available_cores
+
+# Engine settings per hardware profile. cpu_threads None shares the CPU cores
+# between num_workers, 0 leaves the inference library's default.
+PROFILES = {
+    "cuda-float16": {"device": "cuda", "compute_type": "float16", "cpu_threads": 0, "num_workers": 1},
+    "cuda-int8-float16": {"device": "cuda", "compute_type": "int8_float16", "cpu_threads": 0, "num_workers": 1},
+    "cuda-float32": {"device": "cuda", "compute_type": "float32", "cpu_threads": 0, "num_workers": 1},
+    "cpu-int8": {"device": "cpu", "compute_type": "int8", "cpu_threads": None, "num_workers": 1},
+    "cpu-int8-2-workers": {"device": "cpu", "compute_type": "int8", "cpu_threads": None, "num_workers": 2},
+    "cpu-float32": {"device": "cpu", "compute_type": "float32", "cpu_threads": None, "num_workers": 1},
+}
+
+# Below this much GPU memory (MB) int8 weights leave room for larger models
+SMALL_GPU_MB = 6000
+
+
+def detect_gpus():
+    # Asked from nvidia-smi for the same reason as prefork.gpu_count
+    query = ["nvidia-smi", "--query-gpu=name,memory.total,compute_cap", "--format=csv,noheader,nounits"]
+    try:
+        output = subprocess.run(query, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        # Drivers before 510 do not know compute_cap
+        try:
+            output = subprocess.run(query[:1] + ["--query-gpu=name,memory.total", query[2]],
+                                    capture_output=True, text=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return []
+    gpus = []
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split(",")]
+        if len(fields) < 2:
+            continue
+        try:
+            capability = float(fields[2]) if len(fields) > 2 else None
+        except ValueError:
+            capability = None
+        gpus.append({"name": fields[0], "memory_mb": int(float(fields[1])), "compute_capability": capability})
+    return gpus
+
+
+def cpu_flags():
+    try:
+        with open("/proc/cpuinfo", 'r') as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = set(line.split(":", 1)[1].split())
+                    return sorted(flags & {"avx2", "avx512f", "avx512_vnni", "avx_vnni", "amx_int8"})
+    except OSError:
+        pass
+    return []
+
+
+def detect_hardware():
+    return {"gpus": detect_gpus(), "cpu_cores": len(available_cores()), "cpu_flags": cpu_flags()}
+
+
+def candidate_profiles(hardware, engine_class, device=None):
+    # Profiles the engine can run on this machine, most likely fastest first
+    names = []
+    if device != "cpu" and (hardware["gpus"] or device == "cuda"):
+        names += ["cuda-float16", "cuda-int8-float16", "cuda-float32"]
+    if device != "cuda":
+        if hardware["cpu_cores"] >= 8:
+            names.append("cpu-int8-2-workers")
+        names += ["cpu-int8", "cpu-float32"]
+    return [name for name in names if PROFILES[name]["compute_type"] in engine_class.compute_types]
+
+
+def choose_profile(hardware, engine_class, device=None):
+    # Returns (profile name, reason)
+    candidates = candidate_profiles(hardware, engine_class, device)
+    if not candidates:
+        raise ValueError(f"No hardware profile fits the {engine_class.name} engine on device {device}")
+    gpus = hardware["gpus"] if device != "cpu" else []
+    if gpus:
+        gpu = min(gpus, key=lambda gpu: gpu["memory_mb"])
+        capability = gpu["compute_capability"]
+        if capability is not None and capability < 7.0:
+            # No tensor cores before Volta, float16 is slow there
+            preferred, reason = "cuda-int8-float16", f"{gpu['name']} has compute capability {capability}"
+        elif gpu["memory_mb"] < SMALL_GPU_MB:
+            preferred, reason = "cuda-int8-float16", f"{gpu['name']} has {gpu['memory_mb']} MB"
+        else:
+            preferred, reason = "cuda-float16", f"{len(gpus)} x {gpu['name']}"
+    elif device == "cuda":
+        preferred, reason = "cuda-float16", "device cuda requested, no GPU details from nvidia-smi"
+    else:
+        preferred = "cpu-int8-2-workers" if hardware["cpu_cores"] >= 8 else "cpu-int8"
+        reason = f"{'device cpu requested' if device == 'cpu' else 'no GPU'}, {hardware['cpu_cores']} CPU cores"
+    if preferred not in candidates:
+        preferred, reason = candidates[0], reason + f", {engine_class.name} has no {PROFILES[preferred]['compute_type']}"
+    return preferred, reason
+
+
+def resolve_profile(settings, engine_class, hardware=None):
+    # Engine settings from settings["hardware_profile"], where device, compute_type,
+    # cpu_threads and num_workers in settings override single values
+    hardware = hardware if hardware is not None else detect_hardware()
+    name = settings["hardware_profile"]
+    if name == "auto":
+        name, reason = choose_profile(hardware, engine_class, settings["device"])
+    elif name in PROFILES:
+        reason = "configured"
+    else:
+        raise ValueError(f"Unknown hardware profile '{name}', choose auto or one of: {', '.join(PROFILES)}")
+    profile = dict(PROFILES[name])
+    for key in ("device", "compute_type", "cpu_threads", "num_workers"):
+        if settings[key] is not None:
+            profile[key] = settings[key]
+    if profile["cpu_threads"] is None:
+        cores = hardware["cpu_cores"] if profile["device"] == "cpu" else 0
+        profile["cpu_threads"] = max(1, cores // profile["num_workers"]) if cores else 0
+    return dict(profile, profile=name, reason=reason, hardware=hardware)
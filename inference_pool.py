@@ -0,0 +1,191 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+# Request classes from most to least urgent: live dictation chunks, a user waiting
+# on an upload, and queued jobs nobody is watching
+PRIORITIES = ("realtime", "interactive", "batch")
+DEFAULT_PRIORITY = "interactive"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def default_worker_count():
+    # One worker per GPU keeps each device busy without oversubscribing it,
+    # on CPU every worker already uses several threads for inference
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return torch.cuda.device_count()
+    except ImportError:
+        pass
+    return max(1, (os.cpu_count() or 1) // 4)
+
+
+class InferencePool:
+    # Fixed number of inference threads fed from one bounded queue per priority
+    # class. Workers take the most urgent task, where every aging_seconds of
+    # waiting counts as one class higher so batch work is never starved. When a
+    # class's queue is full submit() raises QueueFullError so the server can
+    # answer with 503. realtime_workers are extra threads that only run realtime
+    # tasks, so live dictation never waits behind a long file.
+    # Within a class clients are served by weighted fair queuing: each task is
+    # tagged with the virtual time its client would finish at if every client got
+    # a share of the workers in proportion to its weight, and the smallest tag
+    # runs first, so one client's backlog does not delay everyone else.
+    def __init__(self, workers=None, max_queue=8, aging_seconds=30.0, realtime_workers=0):
+        self.workers = workers or default_worker_count()
+        self.max_queue = max_queue
+        self.aging_seconds = aging_seconds
+        self.pending = {priority: [] for priority in PRIORITIES}
+        self.virtual_time = {priority: 0.0 for priority in PRIORITIES}
+        self.client_finish = {priority: {} for priority in PRIORITIES}
+        self.sequence = itertools.count()
+        self.available = threading.Condition()
+        self.lock = threading.Lock()
+        # Called with (priority, seconds waited) when a task starts
+        self.wait_observer = None
+        # Returns the fair queuing weight of a client
+        self.client_weight = lambda client: 1.0
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.class_completed = {priority: 0 for priority in PRIORITIES}
+        self.class_wait = {priority: 0.0 for priority in PRIORITIES}
+        self.class_max_wait = {priority: 0.0 for priority in PRIORITIES}
+        self.threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(PRIORITIES,), name=f"inference-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        for i in range(realtime_workers):
+            thread = threading.Thread(target=self._worker, args=(("realtime",),), name=f"inference-realtime-{i}",
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def is_full(self, priority=DEFAULT_PRIORITY):
+        with self.available:
+            return len(self.pending[priority]) >= self.max_queue
+
+    def submit(self, fn, *args, priority=DEFAULT_PRIORITY, client=None, cost=1.0, **kwargs):
+        # cost is the work in the client's fair share, e.g. seconds of audio
+        future = Future()
+        with self.available:
+            pending = self.pending[priority]
+            if len(pending) >= self.max_queue:
+                with self.lock:
+                    self.rejected += 1
+                raise QueueFullError()
+            start = max(self.virtual_time[priority], self.client_finish[priority].get(client, 0.0))
+            finish = start + max(cost, 0.01) / self.client_weight(client)
+            self.client_finish[priority][client] = finish
+            heapq.heappush(pending, (finish, next(self.sequence), start, future, time.time(), fn, args, kwargs))
+            self.available.notify_all()
+        return future
+
+    def run(self, fn, *args, priority=DEFAULT_PRIORITY, client=None, cost=1.0, **kwargs):
+        return self.submit(fn, *args, priority=priority, client=client, cost=cost, **kwargs).result()
+
+    def queue_depth(self, priority=None):
+        # Tasks waiting in the given class and the more urgent ones, or all of them
+        with self.available:
+            if priority is None:
+                return sum(len(tasks) for tasks in self.pending.values())
+            return sum(len(self.pending[p]) for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+
+    def retry_after(self, priority=DEFAULT_PRIORITY):
+        # Rough estimate of seconds until a queue slot frees up
+        with self.lock:
+            average_run = self.total_run / self.completed if self.completed else 1.0
+        return max(1, int(average_run * (self.queue_depth(priority) + 1) / self.workers))
+
+    def stats(self):
+        with self.available:
+            depths = {priority: len(tasks) for priority, tasks in self.pending.items()}
+        with self.lock:
+            completed = self.completed
+            return {
+                "workers": self.workers,
+                "queue_depth": sum(depths.values()),
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "completed": completed,
+                "rejected": self.rejected,
+                "average_wait": self.total_wait / completed if completed else 0.0,
+                "max_wait": self.max_wait,
+                "average_run": self.total_run / completed if completed else 0.0,
+                "priorities": {
+                    priority: {
+                        "queue_depth": depths[priority],
+                        "completed": self.class_completed[priority],
+                        "average_wait": (self.class_wait[priority] / self.class_completed[priority]
+                                         if self.class_completed[priority] else 0.0),
+                        "max_wait": self.class_max_wait[priority],
+                    }
+                    for priority in PRIORITIES
+                },
+            }
+
+    def _next(self, classes):
+        # Most urgent head of queue: class rank minus one per aging_seconds waited
+        now = time.time()
+        best = None
+        for rank, priority in enumerate(PRIORITIES):
+            if priority in classes and self.pending[priority]:
+                score = rank - (now - self.pending[priority][0][4]) / self.aging_seconds
+                if best is None or score < best[0]:
+                    best = (score, priority)
+        if best is None:
+            return None
+        priority = best[1]
+        _, _, start, future, queued_at, fn, args, kwargs = heapq.heappop(self.pending[priority])
+        self.virtual_time[priority] = max(self.virtual_time[priority], start)
+        if not self.pending[priority]:
+            # Idle class, every client starts level again
+            self.virtual_time[priority] = 0.0
+            self.client_finish[priority].clear()
+        return priority, (future, queued_at, fn, args, kwargs)
+
+    def _worker(self, classes):
+        while True:
+            with self.available:
+                task = self._next(classes)
+                while task is None:
+                    self.available.wait()
+                    task = self._next(classes)
+            priority, (future, queued_at, fn, args, kwargs) = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.time()
+            wait = started - queued_at
+            with self.lock:
+                self.in_flight += 1
+            if self.wait_observer is not None:
+                self.wait_observer(priority, wait)
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                run = time.time() - started
+                with self.lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+                    self.total_run += run
+                    self.class_completed[priority] += 1
+                    self.class_wait[priority] += wait
+                    self.class_max_wait[priority] = max(self.class_max_wait[priority], wait)
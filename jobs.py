@@ -0,0 +1,200 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    model TEXT NOT NULL,
+    cache_key TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    text TEXT,
+    error TEXT,
+    client TEXT,
+    pid INTEGER
+)
+"""
+
+
+def pid_alive(pid):
+    # POSIX only (like pre-fork workers): on Windows os.kill ends the process
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    # Durable queue of transcription jobs: a SQLite table for the job state and
+    # one file per uploaded recording, both under directory. Jobs survive server
+    # restarts and finished ones are kept for retention_seconds. Recordings and
+    # transcripts are patient data, so keep directory on protected storage.
+    # Several processes may share one directory, only one of them should requeue,
+    # the others can take over the jobs of dead processes with requeue_orphans.
+    def __init__(self, directory, retention_seconds=86400, requeue=True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.retention_seconds = retention_seconds
+        self.db = sqlite3.connect(os.path.join(directory, "jobs.sqlite3"), check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(SCHEMA)
+        columns = [column["name"] for column in self.db.execute("PRAGMA table_info(jobs)")]
+        if "client" not in columns:
+            # Queue created before jobs recorded their client
+            self.db.execute("ALTER TABLE jobs ADD COLUMN client TEXT")
+        if "pid" not in columns:
+            # Queue created before jobs recorded the process running them
+            self.db.execute("ALTER TABLE jobs ADD COLUMN pid INTEGER")
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        if requeue:
+            # Jobs interrupted by a restart start over
+            self.db.execute("UPDATE jobs SET status = 'queued', started = NULL, pid = NULL WHERE status = 'running'")
+
+    def requeue_orphans(self):
+        # Jobs left running by a process that died (e.g. a crashed pre-fork worker)
+        # start over, returns how many
+        with self.lock:
+            rows = self.db.execute("SELECT id, pid FROM jobs WHERE status = 'running'").fetchall()
+            orphans = [row["id"] for row in rows if row["pid"] is None or not pid_alive(row["pid"])]
+            for job_id in orphans:
+                self.db.execute("UPDATE jobs SET status = 'queued', started = NULL, pid = NULL "
+                                "WHERE id = ? AND status = 'running'", (job_id,))
+            if orphans:
+                self.available.notify_all()
+        return len(orphans)
+
+    def close(self):
+        self.db.close()
+
+    def audio_path(self, job_id):
+        return os.path.join(self.directory, job_id + ".audio")
+
+    def submit(self, model_name, audio_data, key=None, text=None, client=None):
+        # A known transcription (e.g. from the result cache) is stored as done
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        if text is None:
+            temp_path = self.audio_path(job_id) + ".tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(audio_data)
+            os.replace(temp_path, self.audio_path(job_id))
+        with self.lock:
+            if text is None:
+                self.db.execute("INSERT INTO jobs (id, status, model, cache_key, created, client) "
+                                "VALUES (?, 'queued', ?, ?, ?, ?)", (job_id, model_name, key, now, client))
+                self.available.notify()
+            else:
+                self.db.execute("INSERT INTO jobs (id, status, model, cache_key, created, started, finished, text, client) "
+                                "VALUES (?, 'done', ?, ?, ?, ?, ?, ?, ?)",
+                                (job_id, model_name, key, now, now, now, text, client))
+        return job_id
+
+    def claim(self, timeout=None):
+        # Marks a queued job as running and returns it, None on timeout. The oldest
+        # job of the client with the fewest running jobs goes first, so one client's
+        # backlog does not hold up everyone else's. Another process may claim the
+        # same row first, then the next one is tried.
+        with self.available:
+            while True:
+                rows = self.db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY "
+                                       "(SELECT COUNT(*) FROM jobs AS running WHERE running.status = 'running' "
+                                       "AND running.client IS jobs.client), created LIMIT 8").fetchall()
+                for row in rows:
+                    claimed = self.db.execute("UPDATE jobs SET status = 'running', started = ?, pid = ? "
+                                              "WHERE id = ? AND status = 'queued'",
+                                              (time.time(), os.getpid(), row["id"])).rowcount
+                    if claimed:
+                        return dict(row)
+                if not self.available.wait(timeout):
+                    return None
+
+    def read_audio(self, job_id):
+        with open(self.audio_path(job_id), 'rb') as f:
+            return f.read()
+
+    def complete(self, job_id, text=None, error=None):
+        with self.lock:
+            self.db.execute("UPDATE jobs SET status = ?, finished = ?, text = ?, error = ? WHERE id = ?",
+                            ("failed" if error is not None else "done", time.time(), text, error, job_id))
+        self._remove_audio(job_id)
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def delete(self, job_id):
+        with self.lock:
+            deleted = self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,)).rowcount
+        self._remove_audio(job_id)
+        return deleted > 0
+
+    def purge(self):
+        cutoff = time.time() - self.retention_seconds
+        with self.lock:
+            expired = [row["id"] for row in self.db.execute(
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (cutoff,))]
+            self.db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (cutoff,))
+        for job_id in expired:
+            self._remove_audio(job_id)
+        return len(expired)
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ("queued", "running", "done", "failed")}
+
+    def _remove_audio(self, job_id):
+        try:
+            os.remove(self.audio_path(job_id))
+        except FileNotFoundError:
+            pass
+
+
+class JobRunner:
+    # Threads that take jobs from the store and pass them to run_job(job, audio_data),
+    # which returns the transcription. Expired jobs are purged every purge_interval seconds.
+    def __init__(self, store, run_job, workers=1, purge_interval=60):
+        self.store = store
+        self.run_job = run_job
+        self.purge_interval = purge_interval
+        self.last_purge = 0.0
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name=f"jobs-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self):
+        while True:
+            if time.time() - self.last_purge > self.purge_interval:
+                self.last_purge = time.time()
+                self.store.purge()
+            job = self.store.claim(timeout=self.purge_interval)
+            if job is None:
+                continue
+            try:
+                audio_data = self.store.read_audio(job["id"])
+            except FileNotFoundError:
+                # Usually deleted by the client while queued, then this updates nothing
+                self.store.complete(job["id"], error="Uploaded audio is missing")
+                continue
+            try:
+                text = self.run_job(job, audio_data)
+            except Exception as e:
+                self.store.complete(job["id"], error=f"{type(e).__name__}: {e}")
+                continue
+            self.store.complete(job["id"], text=text)
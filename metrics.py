@@ -0,0 +1,96 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import threading
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RTF_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    # Minimal thread-safe counters, gauges and histograms rendered in the
+    # Prometheus text exposition format, so /metrics needs no extra package.
+    # constant_labels are added to every series, e.g. the worker process.
+    def __init__(self, constant_labels=None):
+        self.lock = threading.Lock()
+        self.definitions = {}
+        self.values = {}
+        self.constant_labels = tuple(sorted((constant_labels or {}).items()))
+
+    def define(self, name, kind, help_text, buckets=None):
+        self.definitions[name] = (kind, help_text, buckets)
+        self.values.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def clear(self, name):
+        # Drops every series of a metric, for labels that come and go
+        with self.lock:
+            self.values[name] = {}
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.definitions[name][2]
+        with self.lock:
+            series = self.values[name]
+            if key not in series:
+                series[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            histogram = series[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        # JSON-serializable copy of the values, with the constant labels applied
+        with self.lock:
+            return {name: [[list(self.constant_labels + key),
+                            dict(value, buckets=list(value["buckets"])) if isinstance(value, dict) else value]
+                           for key, value in series.items()]
+                    for name, series in self.values.items()}
+
+    def render(self, snapshots=()):
+        # snapshots from other processes are merged into the same metric families
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in self.definitions.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                series = [(self.constant_labels + key, value) for key, value in self.values[name].items()]
+                for snapshot in snapshots:
+                    series.extend((tuple(tuple(label) for label in key), value) for key, value in snapshot.get(name, []))
+                for key, value in series:
+                    if kind != "histogram":
+                        lines.append(f"{name}{_label_text(key)} {_number(value)}")
+                        continue
+                    for bound, count in zip(buckets, value["buckets"]):
+                        lines.append(f"{name}_bucket{_label_text(key + (('le', _number(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{_label_text(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{_label_text(key)} {_number(value['sum'])}")
+                    lines.append(f"{name}_count{_label_text(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
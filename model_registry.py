@@ -0,0 +1,165 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import gc
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Approximate resident size (MB) of each Whisper model family, used for the memory cap
+MODEL_MEMORY_MB = {
+    "tiny": 150,
+    "base": 300,
+    "small": 1000,
+    "medium": 2600,
+    "large": 4700,
+}
+
+
+def estimate_model_memory(model_name):
+    name = model_name.lower()
+    if name.startswith("distil-"):
+        name = name[len("distil-"):]
+    family = name.split(".")[0].split("-")[0]
+    return MODEL_MEMORY_MB.get(family, MODEL_MEMORY_MB["large"])
+
+
+def free_memory():
+    gc.collect()
+    if "torch" in sys.modules:
+        torch = sys.modules["torch"]
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+class ModelRegistry:
+    # Keeps loaded models resident between requests and evicts the least recently
+    # used ones once the estimated memory use goes over max_memory_mb. Requests
+    # hold their model from acquire() to release(), so the default model can be
+    # swapped while older requests finish on the previous one.
+    def __init__(self, loader, default_model, allowed_models=None, max_memory_mb=None):
+        self.loader = loader
+        self.default_model = default_model
+        self.allowed_models = set(allowed_models or [default_model])
+        self.allowed_models.add(default_model)
+        self.max_memory_mb = max_memory_mb
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        self.load_count = 0
+        self.load_seconds = 0.0
+        self.eviction_count = 0
+        self.in_use = {}
+        self.released = threading.Condition(self.lock)
+
+    def resolve(self, model_name):
+        if not model_name:
+            return self.default_model
+        model_name = model_name.strip()
+        if model_name not in self.allowed_models:
+            raise KeyError(model_name)
+        return model_name
+
+    def acquire(self, model_name=None):
+        # Resolves the requested model and holds it until release()
+        with self.lock:
+            model_name = self.resolve(model_name)
+            self.in_use[model_name] = self.in_use.get(model_name, 0) + 1
+            return model_name
+
+    def release(self, model_name):
+        with self.lock:
+            self.in_use[model_name] -= 1
+            if not self.in_use[model_name]:
+                del self.in_use[model_name]
+                self.released.notify_all()
+
+    def allow(self, model_name):
+        # Returns True if model_name was not allowed before
+        with self.lock:
+            added = model_name not in self.allowed_models
+            self.allowed_models.add(model_name)
+            return added
+
+    def forbid(self, model_name):
+        with self.lock:
+            if model_name != self.default_model:
+                self.allowed_models.discard(model_name)
+
+    def set_default(self, model_name):
+        # Requests without a model use model_name from now on, returns the previous default
+        with self.lock:
+            previous = self.default_model
+            self.default_model = model_name
+            self.allowed_models.add(model_name)
+            return previous
+
+    def unload(self, model_name, timeout=None):
+        # Waits up to timeout seconds for requests holding the model, then frees it
+        # unless it is the default again
+        with self.lock:
+            self.released.wait_for(lambda: model_name not in self.in_use, timeout)
+            if model_name == self.default_model or model_name not in self.models:
+                return False
+            del self.models[model_name]
+        free_memory()
+        print(f"Unloaded model '{model_name}'")
+        return True
+
+    def get(self, model_name=None):
+        model_name = self.resolve(model_name)
+        with self.lock:
+            if model_name in self.models:
+                self.models.move_to_end(model_name)
+                return self.models[model_name]
+            load_lock = self.load_locks.setdefault(model_name, threading.Lock())
+
+        # Only one thread loads a given model, the others wait for it
+        with load_lock:
+            with self.lock:
+                if model_name in self.models:
+                    self.models.move_to_end(model_name)
+                    return self.models[model_name]
+            start = time.time()
+            model = self.loader(model_name)
+            elapsed = time.time() - start
+            print(f"Loaded model '{model_name}' in {elapsed:.1f}s")
+            with self.lock:
+                self.models[model_name] = model
+                self.load_count += 1
+                self.load_seconds += elapsed
+                self._evict(keep=model_name)
+            return model
+
+    def preload(self, model_names=None):
+        for model_name in model_names or [self.default_model]:
+            self.get(model_name)
+
+    def memory_mb(self):
+        with self.lock:
+            return sum(estimate_model_memory(name) for name in self.models)
+
+    def loaded_models(self):
+        with self.lock:
+            return list(self.models)
+
+    def _evict(self, keep):
+        if self.max_memory_mb is None:
+            return
+        evicted = False
+        while len(self.models) > 1:
+            used = sum(estimate_model_memory(name) for name in self.models)
+            if used <= self.max_memory_mb:
+                break
+            # The default model and models still used by requests stay
+            oldest = next((name for name in self.models
+                           if name not in (keep, self.default_model) and name not in self.in_use), None)
+            if oldest is None:
+                break
+            del self.models[oldest]
+            self.eviction_count += 1
+            evicted = True
+            print(f"Evicted model '{oldest}' to stay under {self.max_memory_mb} MB")
+        if evicted:
+            free_memory()
@@ -0,0 +1,128 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+from email.message import Message
+
+READ_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+
+
+class MultipartError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_header(value):
+    # Replacement for cgi.parse_header, which went away with the cgi module in Python 3.13
+    message = Message()
+    message['content-type'] = value or ''
+    return message.get_content_type(), dict(message.get_params()[1:])
+
+
+def _content_disposition(value):
+    message = Message()
+    message['content-disposition'] = value or ''
+    return message.get_param('name', header='content-disposition'), message.get_filename()
+
+
+def read_form(headers, rfile, max_size):
+    # Reads a multipart/form-data body straight from the socket. File parts are
+    # returned as bytearrays built in one pass, other fields as strings.
+    ctype, params = parse_header(headers.get('content-type'))
+    if ctype != 'multipart/form-data' or not params.get('boundary'):
+        raise MultipartError(400, "Invalid content type")
+    length = headers.get('content-length')
+    if length is None:
+        raise MultipartError(411, "Content-Length required")
+    try:
+        length = int(length)
+    except ValueError:
+        raise MultipartError(400, "Invalid Content-Length")
+    if length > max_size:
+        raise MultipartError(413, f"Upload larger than {max_size} bytes")
+    return MultipartReader(rfile, params['boundary'].encode('latin-1'), length, max_size).read()
+
+
+class MultipartReader:
+    def __init__(self, rfile, boundary, length, max_size):
+        self.rfile = rfile
+        self.remaining = length
+        self.max_size = max_size
+        self.delimiter = b"\r\n--" + boundary
+        # The first boundary is not preceded by a line break, add one so every
+        # boundary matches the same delimiter
+        self.buffer = bytearray(b"\r\n")
+
+    def _fill(self):
+        if self.remaining <= 0:
+            raise MultipartError(400, "Unexpected end of multipart body")
+        chunk = self.rfile.read(min(READ_SIZE, self.remaining))
+        if not chunk:
+            raise MultipartError(400, "Unexpected end of multipart body")
+        self.remaining -= len(chunk)
+        self.buffer += chunk
+
+    def _skip_to_delimiter(self, part=None, limit=None):
+        # Moves everything before the next delimiter into part (or drops it)
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            end = index if index >= 0 else len(self.buffer) - keep
+            if end > 0:
+                if part is not None:
+                    part += self.buffer[:end]
+                    if len(part) > limit:
+                        raise MultipartError(413, f"Form field larger than {limit} bytes")
+                del self.buffer[:end]
+            if index >= 0:
+                del self.buffer[:len(self.delimiter)]
+                return
+            self._fill()
+
+    def _read_headers(self):
+        while True:
+            index = self.buffer.find(b"\r\n\r\n")
+            if index >= 0:
+                break
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise MultipartError(400, "Multipart headers too large")
+            self._fill()
+        headers = {}
+        for line in bytes(self.buffer[:index]).decode('utf-8', 'replace').split("\r\n"):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        del self.buffer[:index + 4]
+        return headers
+
+    def read(self):
+        fields = {}
+        self._skip_to_delimiter()
+        while True:
+            while len(self.buffer) < 2:
+                self._fill()
+            if self.buffer[:2] == b"--":
+                break
+            # Rest of the boundary line (normally just CRLF)
+            while b"\r\n" not in self.buffer:
+                self._fill()
+            del self.buffer[:self.buffer.find(b"\r\n") + 2]
+
+            headers = self._read_headers()
+            name, filename = _content_disposition(headers.get('content-disposition'))
+            part_type = headers.get('content-type', 'text/plain')
+            is_file = filename is not None or not part_type.startswith('text/')
+            part = bytearray()
+            self._skip_to_delimiter(part, self.max_size if is_file else MAX_FIELD_SIZE)
+            if name is not None and name not in fields:
+                fields[name] = part if is_file else part.decode('utf-8', 'replace')
+
+        # Discard the epilogue so the connection is left clean
+        while self.remaining > 0:
+            chunk = self.rfile.read(min(READ_SIZE, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+        return fields
@@ -0,0 +1,129 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+import traceback
+
+
+def gpu_count():
+    # Asked from nvidia-smi: importing torch here would initialize CUDA in the
+    # parent process, which forked workers cannot use
+    try:
+        output = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    return sum(1 for line in output.splitlines() if line.startswith("GPU "))
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_placements(count, placement="auto", device=None):
+    # "auto" gives each process a GPU (round robin when there are more processes
+    # than GPUs) or an even share of the CPU cores. Otherwise placement lists one
+    # entry per process: "cuda:N", "cpu" for all cores, or a list of core numbers.
+    if placement != "auto":
+        placements = list(placement)
+        if len(placements) < count:
+            raise ValueError(f"process_placement has {len(placements)} entries for {count} processes")
+        return placements[:count]
+    gpus = gpu_count() if device != "cpu" else 0
+    if gpus:
+        return [f"cuda:{i % gpus}" for i in range(count)]
+    cores = available_cores()
+    size = max(1, len(cores) // count)
+    return [cores[i * size:(i + 1) * size if i < count - 1 else len(cores)] or cores for i in range(count)]
+
+
+def describe_placement(placement):
+    if isinstance(placement, str):
+        return placement
+    return "cpu:" + ",".join(str(core) for core in placement)
+
+
+def apply_placement(placement, settings):
+    # Runs in the worker before an inference library is imported, returns the
+    # settings the worker's server uses
+    settings = dict(settings)
+    if isinstance(placement, str) and placement.startswith("cuda"):
+        os.environ["CUDA_VISIBLE_DEVICES"] = placement.partition(":")[2] or "0"
+        settings["device"] = "cuda"
+    else:
+        cores = available_cores() if placement == "cpu" else list(placement)
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        os.environ["OMP_NUM_THREADS"] = str(len(cores))
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+        settings["device"] = "cpu"
+    # Parallelism comes from the processes, each runs one model at a time
+    settings["inference_workers"] = settings["inference_workers"] or 1
+    settings["num_workers"] = settings["num_workers"] or 1
+    return settings
+
+
+def serve_prefork(port, placements, start_worker):
+    # Forks one worker per placement, all accepting from one listening socket.
+    # start_worker(listen_socket, worker) runs a server in the child. Workers
+    # that die are restarted, SIGTERM or Ctrl+C stops all of them.
+    if not hasattr(os, "fork"):
+        raise RuntimeError("Several server processes need a platform with os.fork")
+    listen_socket = socket.create_server(("", port), backlog=128)
+    # A worker that loses the race for a connection goes back to its loop
+    listen_socket.setblocking(False)
+    # Workers publish their metrics here so any of them can answer /metrics
+    metrics_dir = tempfile.mkdtemp(prefix="aiscribe-metrics-")
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                start_worker(listen_socket, {"index": index, "placement": placements[index], "metrics_dir": metrics_dir})
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(len(placements)):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                stop()
+                continue
+            index = children.pop(pid, None)
+            if index is not None and not stopping:
+                print(f"Worker {index} exited with status {status}, restarting it")
+                time.sleep(1)
+                spawn(index)
+    finally:
+        listen_socket.close()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
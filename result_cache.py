@@ -0,0 +1,122 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def cache_key(audio_data, model_name, options=None):
+    # Same audio bytes, model and decode options always give the same transcription
+    digest = hashlib.sha256(audio_data)
+    digest.update(b"\0" + model_name.encode("utf-8"))
+    digest.update(b"\0" + json.dumps(options or {}, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    # LRU cache of transcription results in memory, optionally backed by a
+    # directory of JSON files that survives restarts. Transcripts are patient
+    # data, so only point disk_dir at storage that is protected accordingly.
+    # Keys still being transcribed are tracked too, so identical requests that
+    # arrive meanwhile wait for that result instead of running the model again.
+    def __init__(self, max_entries=256, disk_dir=None, max_disk_entries=5000):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.in_flight = {}
+        self.coalesced = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), 'r') as f:
+                    result = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+            else:
+                os.utime(self._disk_path(key))
+                with self.lock:
+                    self.disk_hits += 1
+                    self._remember(key, result)
+                return result
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        with self.lock:
+            self._remember(key, result)
+        if self.disk_dir:
+            temp_path = self._disk_path(key) + ".tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(result, f)
+            os.replace(temp_path, self._disk_path(key))
+            self._trim_disk()
+
+    def join(self, key):
+        # Returns (future, True) to the first caller of a key, who must call finish();
+        # later callers get (the same future, False) and wait for its result, which
+        # is None when the first caller failed
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self.in_flight[key] = Future()
+            return future, True
+
+    def finish(self, key, result=None):
+        # Stores a successful result and wakes the callers waiting for it
+        if result is not None:
+            self.put(key, result)
+        with self.lock:
+            future = self.in_flight.pop(key, None)
+        if future is not None:
+            future.set_result(result)
+
+    def _remember(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _trim_disk(self):
+        files = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith(".json")]
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "in_flight": len(self.in_flight),
+                "coalesced": self.coalesced,
+            }
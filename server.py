@@ -1,53 +1,1014 @@
 # Copyright (c) 2023 Braedon Hendy
 # This software is released under the GNU General Public License v3.0
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import whisper
-import cgi
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from engines import create_engine, ENGINES
+from model_registry import ModelRegistry
+from inference_pool import InferencePool, QueueFullError, PRIORITIES, DEFAULT_PRIORITY
+from batching import MicroBatcher
+from multipart import read_form, MultipartError
+from sessions import SessionStore
+from result_cache import ResultCache, cache_key
+from vad import EnergyVAD
+from hardware import resolve_profile, PROFILES
+from clients import ClientRegistry, ClientLimitError
+from chunked import ChunkedTranscriber
+from jobs import JobStore, JobRunner
+from prefork import plan_placements, apply_placement, describe_placement, serve_prefork
+from audio_decode import decode_audio, get_decode_stats, measure_ffmpeg_baseline, audio_format, AudioDecodeError, SAMPLE_RATE
+from metrics import Metrics, TIME_BUCKETS, RTF_BUCKETS
+import argparse
+import hmac
 import json
 import os
-import tempfile
+import queue
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+import numpy as np
 
-# Initialize Whisper model
-model = whisper.load_model("medium")
+default_settings = {
+    # Inference engine: openai-whisper, faster-whisper, whisperx or fake
+    "engine": "openai-whisper",
+    # Model loaded at startup (engine default when None) and the models a
+    # request may select with the "model" form field
+    "model": None,
+    "available_models": None,
+    # Device, compute type, CPU threads per model and transcriptions one model runs
+    # at once come from a hardware profile: "auto" picks one for the GPUs and CPU
+    # cores found at startup, or name one of hardware.PROFILES (python benchmark.py
+    # --profiles finds the fastest here). The other four override single values,
+    # e.g. "cpu" / "int8".
+    "hardware_profile": "auto",
+    "device": None,
+    "compute_type": None,
+    "cpu_threads": None,
+    "num_workers": None,
+    # Options passed to every transcribe call, also part of the result cache key
+    "decode_options": None,
+    # Least recently used models are unloaded above this estimated memory use (MB)
+    "max_model_memory_mb": 6000,
+    # Largest accepted upload in bytes (about 9 hours of 16 kHz 16-bit WAV)
+    "max_upload_size": 1024 * 1024 * 1024,
+    # Silence detection before inference, False transcribes full recordings.
+    # vad_threshold_db is how far above the noise floor speech has to be; lower
+    # it further for very noisy rooms.
+    "voice_activity": True,
+    "vad_threshold_db": 6.0,
+    # Transcriptions kept in memory for repeated uploads, and an optional directory
+    # (e.g. "cache") where they also persist across restarts
+    "result_cache_entries": 256,
+    "result_cache_dir": None,
+    # Inference threads (one per GPU, or the profile's num_workers on CPU, when None)
+    # and how many requests may wait for one
+    "inference_workers": None,
+    "max_queued_requests": 8,
+    # Concurrent requests arriving within batch_max_wait seconds are transcribed
+    # together by engines that support it
+    "batch_size": 16,
+    "batch_max_wait": 0.05,
+    # Requests carry a priority class (realtime, interactive or batch) and are
+    # served most urgent first; each priority_aging_seconds of waiting raises a
+    # request by one class. realtime_workers are extra inference threads kept for
+    # realtime chunks so live dictation never waits behind a long file.
+    "priority_aging_seconds": 30.0,
+    "realtime_workers": 0,
+    # Callers send "Authorization: Bearer <token>" for a token listed in clients,
+    # e.g. {"<token>": {"name": "dr-smith", "weight": 2, "max_concurrent": 2,
+    # "audio_seconds_per_minute": 600}}, or are named by their address and get
+    # client_defaults. trust_client_id names them by an X-Client-Id header instead,
+    # e.g. behind a proxy; any caller can set it. Inference is shared between
+    # clients by weight; 0 means no limit. require_client_token refuses everyone else.
+    "clients": {},
+    "client_defaults": {"weight": 1, "max_concurrent": 0, "audio_seconds_per_minute": 0},
+    "require_client_token": False,
+    "trust_client_id": False,
+    # Models loaded and warmed up before /readyz reports ready (the default model
+    # when None), and the length of the synthetic clip used to warm them up
+    "preload_models": None,
+    "warmup_seconds": 2.0,
+    # Recordings with more than long_audio_min_seconds of speech are split at pauses
+    # into chunks of about long_audio_chunk_seconds and transcribed in parallel by
+    # long_audio_processes processes, each loading its own copy of the model.
+    # 0 disables it; on CPU nodes use e.g. device "cpu" and compute type "int8".
+    "long_audio_processes": 0,
+    "long_audio_chunk_seconds": 60.0,
+    "long_audio_min_seconds": 300.0,
+    # Directory of the durable /whisperaudio/jobs queue (disabled when None), how long
+    # finished jobs are kept, and how many run at once (one per inference worker
+    # when None). It holds recordings and transcripts, so use protected storage.
+    "jobs_dir": None,
+    "job_retention_seconds": 86400,
+    "job_workers": None,
+    # POST /admin/model {"model": "large-v3"} loads and warms a model in the
+    # background, makes it the default once warm and unloads the previous default
+    # when its last request has finished (waiting at most model_drain_seconds).
+    # Admin requests need "Authorization: Bearer <admin_token>", or come from this
+    # machine when it is None.
+    "admin_token": None,
+    "model_drain_seconds": 600,
+    # Seconds an idle HTTP/1.1 keep-alive connection stays open
+    "keepalive_timeout": 75,
+    # Server processes sharing the port, each with its own models (Linux / macOS).
+    # "auto" placement gives each one a GPU or an even share of the CPU cores,
+    # or list one entry per process: "cuda:0", "cpu" or core numbers like [0, 1, 2, 3]
+    "server_processes": 1,
+    "process_placement": "auto",
+    "port": 8000,
+}
+
+class WhisperServer(ThreadingHTTPServer):
+    # HTTP front end shared by all engines, holding the models, inference pool,
+    # caches and realtime sessions that the request handlers use
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, settings, listen_socket=None, worker=None):
+        if listen_socket is None:
+            super().__init__(server_address, handler_class)
+        else:
+            # Pre-fork worker, the parent already bound the shared socket
+            super().__init__(server_address, handler_class, bind_and_activate=False)
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+        self.settings = settings
+        self.worker = worker
+        self.profile = resolve_profile(settings, ENGINES[settings["engine"]])
+        print(f"Hardware profile {self.profile['profile']} ({self.profile['reason']}): device {self.profile['device']}, "
+              f"compute type {self.profile['compute_type']}, {self.profile['cpu_threads'] or 'default'} CPU threads, "
+              f"{self.profile['num_workers']} workers per model")
+        self.engine = create_engine(settings["engine"], device=self.profile["device"],
+                                    compute_type=self.profile["compute_type"], batch_size=settings["batch_size"],
+                                    decode_options=settings["decode_options"], cpu_threads=self.profile["cpu_threads"],
+                                    num_workers=self.profile["num_workers"])
+        self.models = ModelRegistry(self.engine.load_model, settings["model"] or self.engine.default_model,
+                                    settings["available_models"] or self.engine.available_models,
+                                    settings["max_model_memory_mb"])
+        inference_workers = settings["inference_workers"]
+        if inference_workers is None and self.profile["device"] == "cpu":
+            inference_workers = self.profile["num_workers"]
+        self.pool = InferencePool(inference_workers, settings["max_queued_requests"],
+                                  settings["priority_aging_seconds"], settings["realtime_workers"])
+        self.clients = ClientRegistry(settings["clients"], settings["client_defaults"], settings["require_client_token"],
+                                      settings["trust_client_id"])
+        self.pool.client_weight = self.clients.weight
+        self.batcher = None
+        if self.engine.supports_batching:
+            self.batcher = MicroBatcher(self.transcribe_batch, self.pool, settings["batch_size"], settings["batch_max_wait"])
+        self.voice_activity = EnergyVAD(threshold_db=settings["vad_threshold_db"]) if settings["voice_activity"] else None
+        self.results = ResultCache(settings["result_cache_entries"], settings["result_cache_dir"])
+        self.sessions = SessionStore(self.engine.transcribe_window, self.voice_activity)
+        self.chunker = None
+        if settings["long_audio_processes"]:
+            self.chunker = ChunkedTranscriber(self.engine, self.models.default_model, settings["long_audio_processes"],
+                                              self.voice_activity or EnergyVAD(threshold_db=settings["vad_threshold_db"]),
+                                              settings["long_audio_chunk_seconds"],
+                                              settings["long_audio_min_seconds"])
+        self.metrics = Metrics({"worker": str(worker["index"])} if worker else None)
+        self.define_metrics()
+        self.pool.wait_observer = lambda priority, wait: self.metrics.observe("aiscribe_queue_wait_seconds", wait,
+                                                                               priority=priority)
+        self.ready = threading.Event()
+        self.warmup_error = None
+        # Default model swap in progress or last finished, and the models it replaced
+        self.swap = {"status": "idle"}
+        self.swap_lock = threading.Lock()
+        self.swap_id = None
+        self.retired_models = set()
+        self.metrics.set("aiscribe_ready", 0)
+        self.metrics.set("aiscribe_hardware_profile_info", 1, profile=self.profile["profile"],
+                         device=str(self.profile["device"]), compute_type=str(self.profile["compute_type"]),
+                         cpu_threads=str(self.profile["cpu_threads"]), num_workers=str(self.profile["num_workers"]))
+        self.jobs = None
+        if settings["jobs_dir"]:
+            # Pre-fork workers share the queue, the parent requeued interrupted jobs. A
+            # worker restarted after a crash takes over the jobs its predecessor left running.
+            self.jobs = JobStore(settings["jobs_dir"], settings["job_retention_seconds"], requeue=worker is None)
+            if worker is not None:
+                self.jobs.requeue_orphans()
+            JobRunner(self.jobs, self.run_job, settings["job_workers"] or self.pool.workers)
+        if worker is not None:
+            self.metrics.set("aiscribe_worker_info", 1, placement=describe_placement(worker["placement"]),
+                             pid=str(os.getpid()))
+            threading.Thread(target=self.publish_metrics, daemon=True).start()
+
+    def define_metrics(self):
+        metrics = self.metrics
+        metrics.define("aiscribe_requests_total", "counter", "HTTP responses by endpoint, method and status")
+        metrics.define("aiscribe_requests_in_flight", "gauge", "HTTP requests currently being handled")
+        metrics.define("aiscribe_connections_total", "counter", "TCP connections accepted")
+        metrics.define("aiscribe_received_bytes_total", "counter", "Bytes of uploaded request bodies")
+        metrics.define("aiscribe_multipart_parse_seconds", "histogram", "Time to read and parse uploads", TIME_BUCKETS)
+        metrics.define("aiscribe_audio_decode_seconds", "histogram", "Time to decode uploads to 16 kHz samples by format",
+                       TIME_BUCKETS)
+        metrics.define("aiscribe_audio_bytes_total", "counter", "Bytes of uploaded audio files by format")
+        metrics.define("aiscribe_audio_seconds_total", "counter", "Seconds of decoded audio received by format")
+        metrics.define("aiscribe_queue_wait_seconds", "histogram", "Time waiting for an inference worker by priority",
+                       TIME_BUCKETS)
+        metrics.define("aiscribe_inference_seconds", "histogram", "Time from queueing to finished inference by priority",
+                       TIME_BUCKETS)
+        metrics.define("aiscribe_real_time_factor", "histogram", "Inference time divided by audio length", RTF_BUCKETS)
+        metrics.define("aiscribe_inference_queue_depth", "gauge", "Requests waiting for an inference worker")
+        metrics.define("aiscribe_inference_in_flight", "gauge", "Requests running on an inference worker")
+        metrics.define("aiscribe_inference_workers", "gauge", "Inference worker threads")
+        metrics.define("aiscribe_inference_rejected_total", "counter", "Requests refused because the queue was full")
+        metrics.define("aiscribe_model_loads_total", "counter", "Models loaded since start")
+        metrics.define("aiscribe_model_load_seconds_total", "counter", "Time spent loading models")
+        metrics.define("aiscribe_model_evictions_total", "counter", "Models unloaded to stay under the memory cap")
+        metrics.define("aiscribe_models_loaded", "gauge", "Models currently resident")
+        metrics.define("aiscribe_result_cache_hits_total", "counter", "Uploads answered from the result cache")
+        metrics.define("aiscribe_result_cache_misses_total", "counter", "Uploads not found in the result cache")
+        metrics.define("aiscribe_coalesced_requests_total", "counter",
+                       "Requests that waited for an identical request in progress instead of running the model")
+        metrics.define("aiscribe_model_warmup_seconds", "gauge", "Time the startup warmup clip took per model")
+        metrics.define("aiscribe_ready", "gauge", "1 once startup warmup has finished")
+        metrics.define("aiscribe_jobs", "gauge", "Jobs in the durable queue by status")
+        metrics.define("aiscribe_client_requests_total", "counter", "Inference requests accepted per client")
+        metrics.define("aiscribe_client_rejected_total", "counter", "Requests refused per client and limit")
+        metrics.define("aiscribe_client_in_flight", "gauge", "Requests currently handled per client")
+        metrics.define("aiscribe_client_audio_seconds_total", "counter", "Seconds of audio received per client")
+        metrics.define("aiscribe_client_inference_seconds_total", "counter", "Inference time used per client")
+        metrics.define("aiscribe_worker_info", "gauge", "Placement and process id of each server process")
+        metrics.define("aiscribe_hardware_profile_info", "gauge", "Hardware profile and engine settings in use")
+        metrics.define("aiscribe_model_swaps_total", "counter", "Default model swaps by result")
+        metrics.define("aiscribe_models_in_use", "gauge", "Requests holding each model")
+        metrics.define("aiscribe_worker_load", "gauge", "Requests running or queued for inference in this process")
+
+    def load(self):
+        pool = self.pool.stats()
+        return pool["in_flight"] + pool["queue_depth"]
+
+    def get_request(self):
+        # Pre-fork workers race to accept from the shared socket, busier ones wait a
+        # little first so the connection usually goes to the least loaded process
+        if self.worker is not None:
+            load = self.load()
+            if load:
+                time.sleep(min(load, 20) * 0.002)
+        return super().get_request()
+
+    def publish_metrics(self):
+        # Every few seconds, so /metrics on any worker can include all of them
+        path = os.path.join(self.worker["metrics_dir"], f"worker-{self.worker['index']}.json")
+        while True:
+            self.follow_model_swap()
+            self.update_metrics()
+            with open(path + ".tmp", 'w') as f:
+                json.dump(self.metrics.snapshot(), f)
+            os.replace(path + ".tmp", path)
+            time.sleep(5)
+
+    def follow_model_swap(self):
+        # A swap requested on another pre-fork worker is repeated here
+        try:
+            with open(os.path.join(self.worker["metrics_dir"], "default-model.ctl"), 'r') as f:
+                request = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        if request["id"] != self.swap_id:
+            self.start_model_swap(request["model"], request["id"])
+
+    def worker_snapshots(self):
+        snapshots = []
+        own = f"worker-{self.worker['index']}.json"
+        for name in sorted(os.listdir(self.worker["metrics_dir"])):
+            if name.endswith(".json") and name != own:
+                try:
+                    with open(os.path.join(self.worker["metrics_dir"], name), 'r') as f:
+                        snapshots.append(json.load(f))
+                except (OSError, json.JSONDecodeError):
+                    pass
+        return snapshots
+
+    def metrics_text(self):
+        self.update_metrics()
+        return self.metrics.render(self.worker_snapshots() if self.worker is not None else ())
+
+    def update_metrics(self):
+        # Values owned by other components are copied in when scraped
+        metrics = self.metrics
+        pool = self.pool.stats()
+        metrics.set("aiscribe_worker_load", pool["in_flight"] + pool["queue_depth"])
+        metrics.set("aiscribe_inference_queue_depth", pool["queue_depth"])
+        metrics.set("aiscribe_inference_in_flight", pool["in_flight"])
+        metrics.set("aiscribe_inference_workers", pool["workers"])
+        metrics.set("aiscribe_inference_rejected_total", pool["rejected"])
+        metrics.set("aiscribe_model_loads_total", self.models.load_count)
+        metrics.set("aiscribe_model_load_seconds_total", self.models.load_seconds)
+        metrics.set("aiscribe_model_evictions_total", self.models.eviction_count)
+        metrics.set("aiscribe_models_loaded", len(self.models.loaded_models()))
+        for model_name in self.models.loaded_models():
+            metrics.set("aiscribe_models_in_use", self.models.in_use.get(model_name, 0), model=model_name)
+        cache = self.results.stats()
+        metrics.set("aiscribe_result_cache_hits_total", cache["hits"] + cache["disk_hits"])
+        metrics.set("aiscribe_result_cache_misses_total", cache["misses"])
+        if self.jobs is not None:
+            for status, count in self.jobs.stats().items():
+                metrics.set("aiscribe_jobs", count, status=status)
+        # Forgotten clients drop out of the metrics too
+        for name in ("aiscribe_client_requests_total", "aiscribe_client_rejected_total", "aiscribe_client_in_flight",
+                     "aiscribe_client_audio_seconds_total", "aiscribe_client_inference_seconds_total"):
+            metrics.clear(name)
+        for client, usage in self.clients.stats().items():
+            metrics.set("aiscribe_client_requests_total", usage["requests"], client=client)
+            for reason, count in usage["rejected"].items():
+                metrics.set("aiscribe_client_rejected_total", count, client=client, reason=reason)
+            metrics.set("aiscribe_client_in_flight", usage["in_flight"], client=client)
+            metrics.set("aiscribe_client_audio_seconds_total", usage["audio_seconds"], client=client)
+            metrics.set("aiscribe_client_inference_seconds_total", usage["inference_seconds"], client=client)
+
+    def record_decode(self, audio_data, audio, started):
+        upload_format = audio_format(audio_data)
+        self.metrics.observe("aiscribe_audio_decode_seconds", time.time() - started, format=upload_format)
+        self.metrics.inc("aiscribe_audio_bytes_total", len(audio_data), format=upload_format)
+        self.metrics.inc("aiscribe_audio_seconds_total", len(audio) / SAMPLE_RATE, format=upload_format)
+
+    def result_key(self, audio_data, model_name):
+        # Decode options and voice activity settings change the transcription, so
+        # results cached under other settings (e.g. on disk) are not reused
+        voice_activity = self.voice_activity.options() if self.voice_activity is not None else None
+        return cache_key(audio_data, model_name, dict(self.engine.decode_options, engine=self.engine.name,
+                                                      voice_activity=voice_activity))
+
+    def record_inference(self, endpoint, started, audio_seconds, priority=DEFAULT_PRIORITY, client=None):
+        elapsed = time.time() - started
+        if client is not None:
+            self.clients.record_inference(client, elapsed)
+        self.metrics.observe("aiscribe_inference_seconds", elapsed, endpoint=endpoint, priority=priority)
+        if audio_seconds > 0:
+            self.metrics.observe("aiscribe_real_time_factor", elapsed / audio_seconds, endpoint=endpoint, priority=priority)
+
+    def warm_up(self):
+        # Loads the startup models and runs a synthetic clip through each, so CUDA /
+        # CTranslate2 initialization is not paid by the first real request
+        audio = warmup_audio(self.settings["warmup_seconds"])
+        try:
+            for model_name in self.settings["preload_models"] or [self.models.default_model]:
+                model = self.models.get(model_name)
+                started = time.time()
+                self.engine.transcribe(model, audio)
+                elapsed = time.time() - started
+                self.metrics.set("aiscribe_model_warmup_seconds", elapsed, model=model_name)
+                print(f"Warmed up model '{model_name}' in {elapsed:.1f}s")
+            if self.chunker is not None:
+                started = time.time()
+                self.chunker.warm_up(audio)
+                print(f"Started {self.chunker.processes} long audio processes in {time.time() - started:.1f}s")
+            # What decoding in-process saves is estimated against this until uploads need ffmpeg
+            measure_ffmpeg_baseline(audio)
+        except Exception as e:
+            self.warmup_error = f"{type(e).__name__}: {e}"
+            print(f"Warmup failed: {self.warmup_error}")
+            return
+        self.metrics.set("aiscribe_ready", 1)
+        self.ready.set()
+
+    def start_model_swap(self, model_name, swap_id=None):
+        # Returns (status, body) for the admin endpoint
+        with self.swap_lock:
+            if self.swap["status"] in ("loading", "warming", "draining"):
+                return 409, dict(self.swap, error="A model swap is already in progress")
+            self.swap_id = swap_id or uuid.uuid4().hex
+            self.swap = {"status": "loading", "model": model_name, "previous": self.models.default_model,
+                         "started": time.time()}
+        if self.worker is not None and swap_id is None:
+            # Other workers pick it up from the shared directory
+            path = os.path.join(self.worker["metrics_dir"], "default-model.ctl")
+            with open(path + ".tmp", 'w') as f:
+                json.dump({"id": self.swap_id, "model": model_name}, f)
+            os.replace(path + ".tmp", path)
+        threading.Thread(target=self.swap_model, args=(model_name,), name="model-swap", daemon=True).start()
+        return 202, dict(self.swap)
+
+    def update_swap(self, **changes):
+        with self.swap_lock:
+            self.swap = dict(self.swap, **changes)
+
+    def swap_model(self, model_name):
+        # Loads and warms the new model next to the current one, which keeps serving
+        # until the switch, then frees the previous default once it has drained
+        added = self.models.allow(model_name)
+        try:
+            started = time.time()
+            model = self.models.get(model_name)
+            self.update_swap(status="warming")
+            self.engine.transcribe(model, warmup_audio(self.settings["warmup_seconds"]))
+            self.metrics.set("aiscribe_model_warmup_seconds", time.time() - started, model=model_name)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"Swapping to model '{model_name}' failed: {error}")
+            self.models.unload(model_name, 0)
+            if added:
+                self.models.forbid(model_name)
+            self.update_swap(status="failed", error=error, finished=time.time())
+            self.metrics.inc("aiscribe_model_swaps_total", result="failed")
+            return
+        previous = self.models.set_default(model_name)
+        if self.chunker is not None:
+            self.chunker.default_model = model_name
+        # Queued jobs that asked for the previous default run on the new one
+        self.retired_models.discard(model_name)
+        if previous != model_name:
+            self.retired_models.add(previous)
+        self.update_swap(status="draining", switched=time.time())
+        print(f"Default model is now '{model_name}', draining '{previous}'")
+        if previous != model_name:
+            self.models.unload(previous, self.settings["model_drain_seconds"])
+        self.update_swap(status="done", finished=time.time())
+        self.metrics.inc("aiscribe_model_swaps_total", result="done")
+
+    def health(self):
+        # Alive unless warmup failed, a node that cannot load its model needs a restart
+        if self.warmup_error is not None:
+            return 500, {"status": "failed", "error": self.warmup_error}
+        return 200, {"status": "ok"}
+
+    def readiness(self):
+        if self.ready.is_set():
+            return 200, {"status": "ready", "models": self.models.loaded_models()}
+        if self.warmup_error is not None:
+            return 503, {"status": "failed", "error": self.warmup_error}
+        return 503, {"status": "warming up"}
+
+    def transcribe_batch(self, model_name, audios):
+        return self.engine.transcribe_batch(self.models.get(model_name), audios)
+
+    def transcribe(self, model_name, audio, priority=DEFAULT_PRIORITY, client=None):
+        # Fair queuing charges each client for the seconds of audio it sends to the model
+        cost = len(audio) / SAMPLE_RATE
+        if self.chunker is not None and self.chunker.should_chunk(audio):
+            # Holds one inference slot while the chunks run in the process pool
+            return self.pool.run(self.chunker.transcribe, model_name, audio, priority=priority, client=client, cost=cost)
+        if self.batcher is not None:
+            return self.batcher.submit(model_name, audio, priority, client, cost).result()
+        return self.pool.run(self.engine.transcribe, self.models.get(model_name), audio, priority=priority,
+                             client=client, cost=cost)
+
+    def status(self):
+        status = self.pool.stats()
+        if self.batcher is not None:
+            status.update(self.batcher.stats())
+        status["engine"] = self.engine.name
+        status["hardware"] = self.profile
+        status["models"] = self.models.loaded_models()
+        status["default_model"] = self.models.default_model
+        with self.swap_lock:
+            status["model_swap"] = dict(self.swap)
+        status["decode"] = get_decode_stats()
+        status["cache"] = self.results.stats()
+        if self.chunker is not None:
+            status["long_audio"] = self.chunker.stats()
+        if self.jobs is not None:
+            status["jobs"] = self.jobs.stats()
+        status["clients"] = self.clients.stats()
+        if self.worker is not None:
+            status["worker"] = {"index": self.worker["index"], "pid": os.getpid(),
+                                "placement": describe_placement(self.worker["placement"])}
+        return status
+
+    def coalesce(self, key):
+        # Returns (transcription, False) when an identical request finished meanwhile,
+        # else (None, True) if this request has to transcribe the audio and call
+        # results.finish(), or (None, False) if it should without sharing the result
+        future, owner = self.results.join(key)
+        if owner:
+            return None, True
+        print(f"Waiting for an identical request already in progress ({key[:12]})")
+        self.metrics.inc("aiscribe_coalesced_requests_total")
+        return future.result(), False
+
+    def run_job(self, job, audio_data):
+        # Same steps as /whisperaudio, run by the job threads. Jobs queued for a
+        # default model that has been swapped out since run on the new default.
+        model_name = self.models.acquire(None if job["model"] in self.retired_models else job["model"])
+        try:
+            return self.run_job_on(job, model_name, audio_data)
+        finally:
+            self.models.release(model_name)
+
+    def run_job_on(self, job, model_name, audio_data):
+        key = job["cache_key"] if model_name == job["model"] else None
+        owner = False
+        if key:
+            # A duplicate upload may have been transcribed since this job was queued
+            transcription = self.results.get(key)
+            if transcription is None:
+                transcription, owner = self.coalesce(key)
+            if transcription is not None:
+                return transcription
+        transcription = None
+        try:
+            transcription = self.transcribe_job(job, model_name, audio_data)
+        finally:
+            if owner:
+                self.results.finish(key, transcription)
+            elif key and transcription is not None:
+                self.results.put(key, transcription)
+        return transcription
+
+    def transcribe_job(self, job, model_name, audio_data):
+        started = time.time()
+        audio = decode_audio(audio_data)
+        self.record_decode(audio_data, audio, started)
+        audio_seconds = len(audio) / SAMPLE_RATE
+        if job["client"] is not None:
+            self.clients.charge(job["client"], audio_seconds)
+        if self.voice_activity is not None:
+            audio, _ = self.voice_activity.compress(audio)
+        transcription = ""
+        if len(audio):
+            while True:
+                started = time.time()
+                try:
+                    transcription = self.transcribe(model_name, audio, "batch", job["client"])
+                    break
+                except QueueFullError:
+                    # Jobs wait for a free slot instead of being refused
+                    time.sleep(self.pool.retry_after("batch"))
+            self.record_inference('/whisperaudio/jobs', started, audio_seconds, "batch", job["client"])
+        return transcription
+
+    def transcribe_segments(self, model_name, audio, emit):
+        if self.chunker is not None and self.chunker.should_chunk(audio):
+            self.chunker.transcribe_segments(model_name, audio, emit)
+        else:
+            self.engine.transcribe_segments(self.models.get(model_name), audio, emit)
 
 class RequestHandler(BaseHTTPRequestHandler):
+    # Persistent connections, so realtime chunks and polls skip the TCP / TLS
+    # handshake. Every response needs a Content-Length or has to close.
+    protocol_version = "HTTP/1.1"
+    in_flight = False
+    priority = DEFAULT_PRIORITY
+    client = None
+    client_acquired = False
+    held_model = None
+
+    def setup(self):
+        # Also bounds how long a stalled upload may block its thread
+        self.timeout = self.server.settings["keepalive_timeout"]
+        super().setup()
+        self.server.metrics.inc("aiscribe_connections_total")
+
+    def endpoint(self):
+        # Session ids are dropped so metrics keep a fixed set of labels
+        path = self.path.split('?')[0]
+        if path.startswith('/whisperaudio/session/'):
+            return '/whisperaudio/session/{id}'
+        if path.startswith('/whisperaudio/jobs/'):
+            return '/whisperaudio/jobs/{id}/result' if path.endswith('/result') else '/whisperaudio/jobs/{id}'
+        if path in ('/whisperaudio', '/whisperaudio/stream', '/whisperaudio/session', '/whisperaudio/jobs',
+                    '/status', '/metrics', '/healthz', '/readyz', '/admin/model'):
+            return path
+        return 'other'
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # Per request state, the connection may be reused
+        self.priority = DEFAULT_PRIORITY
+        self.client = None
+        self.in_flight = True
+        self.server.metrics.inc("aiscribe_requests_in_flight")
+        return True
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            if self.client_acquired:
+                self.client_acquired = False
+                self.server.clients.release(self.client)
+            if self.held_model is not None:
+                self.server.models.release(self.held_model)
+                self.held_model = None
+            if self.in_flight:
+                self.in_flight = False
+                self.server.metrics.inc("aiscribe_requests_in_flight", -1)
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.server.metrics.inc("aiscribe_requests_total", endpoint=self.endpoint(), method=self.command, status=code)
+
+    def send_busy(self):
+        self.send_retry(503, "Server busy, retry later", self.server.pool.retry_after(self.priority))
+
+    def send_retry(self, status, message, retry_after):
+        body = json.dumps({"error": message}).encode()
+        self.send_response(status)
+        self.send_header('Retry-After', str(retry_after))
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        # The upload may not have been read, so the connection cannot be reused
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def identify_client(self, limited=False):
+        # Names the caller and, for uploads, starts a request within its limits.
+        # Returns False after an error response.
+        self.client = self.server.clients.identify(self.headers, self.client_address)
+        if self.client is None:
+            self.send_error(401, "Missing or unknown client token")
+            return False
+        if limited:
+            try:
+                self.server.clients.acquire(self.client)
+            except ClientLimitError as e:
+                if e.reason == "concurrency":
+                    message = "Too many requests from this client at once"
+                else:
+                    message = "Audio budget of this client used up, retry later"
+                self.send_retry(429, message, e.retry_after)
+                return False
+            self.client_acquired = True
+        return True
+
+    def is_admin(self):
+        # Returns False after an error response
+        token = self.server.settings["admin_token"]
+        if token is None:
+            allowed = self.client_address[0] in ('127.0.0.1', '::1')
+        else:
+            allowed = hmac.compare_digest(self.headers.get('Authorization', ''), 'Bearer ' + token)
+        if not allowed:
+            self.send_error(403, "Admin requests need the admin token")
+        return allowed
+
+    def choose_priority(self, default, fields=None):
+        # Form field "priority" or X-Priority header, returns False after an error response
+        priority = ((fields or {}).get('priority') or self.headers.get('X-Priority') or default).strip().lower()
+        if priority not in PRIORITIES:
+            self.send_error(400, f"Unknown priority '{priority}', choose one of: {', '.join(PRIORITIES)}")
+            return False
+        self.priority = priority
+        return True
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(self.server.status())
+        elif self.path == '/healthz':
+            status, body = self.server.health()
+            self.send_json(body, status)
+        elif self.path == '/readyz':
+            status, body = self.server.readiness()
+            self.send_json(body, status)
+        elif self.path.startswith('/whisperaudio/jobs/'):
+            if not self.identify_client():
+                return
+            job_id = self.path[len('/whisperaudio/jobs/'):]
+            fetch = job_id.endswith('/result')
+            job = self.job_from_path(job_id[:-len('/result')] if fetch else job_id)
+            if job is None:
+                return
+            if not fetch:
+                self.send_job(job)
+            elif job["status"] == "done":
+                self.send_json({"text": job["text"]})
+            elif job["status"] == "failed":
+                self.send_json({"error": job["error"]}, 500)
+            else:
+                # Not finished yet, poll again later
+                self.send_json({"job": job["id"], "status": job["status"]}, 202)
+        elif self.path == '/admin/model':
+            if self.is_admin():
+                with self.server.swap_lock:
+                    self.send_json(dict(self.server.swap, default_model=self.server.models.default_model))
+        elif self.path == '/metrics':
+            body = self.server.metrics_text().encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404, "File not found")
+
+    def read_upload(self):
+        # Parses the upload, returns None after sending an error response
+        metrics = self.server.metrics
+        started = time.time()
+        try:
+            fields = read_form(self.headers, self.rfile, self.server.settings["max_upload_size"])
+        except MultipartError as e:
+            self.send_error(e.status, str(e))
+            return None
+        metrics.observe("aiscribe_multipart_parse_seconds", time.time() - started)
+        metrics.inc("aiscribe_received_bytes_total", int(self.headers.get('content-length', 0)))
+        audio_data = fields.get('audio')
+        if not isinstance(audio_data, bytearray):
+            self.send_error(400, "Missing audio file")
+            return None
+        try:
+            # Held until the response is sent, so a model swap waits for this request
+            model_name = self.held_model = self.server.models.acquire(fields.get('model'))
+        except KeyError as e:
+            self.send_error(400, f"Unknown model {e}")
+            return None
+        if not self.choose_priority(self.priority, fields):
+            return None
+        return model_name, audio_data
+
+    def decode_upload(self, audio_data):
+        # Decode here so the inference threads only run the model
+        started = time.time()
+        try:
+            audio = decode_audio(audio_data)
+        except AudioDecodeError as e:
+            self.send_error(400, str(e))
+            return None
+        self.server.record_decode(audio_data, audio, started)
+        self.server.clients.charge(self.client, len(audio) / SAMPLE_RATE)
+        return audio
+
+    def stream_segments(self, model_name, audio, audio_seconds, speech_map=None):
+        # Writes one JSON line per segment as soon as the model produces it
+        segments = queue.Queue()
+        disconnected = threading.Event()
+
+        def emit(segment):
+            if speech_map is not None:
+                speech_map.restore_segments([segment])
+            segments.put(segment)
+            return not disconnected.is_set()
+
+        if len(audio) == 0:
+            # Only silence, answer without running the model
+            future = Future()
+            future.set_result(None)
+        else:
+            started = time.time()
+            try:
+                future = self.server.pool.submit(self.server.transcribe_segments, model_name, audio, emit,
+                                                 priority=self.priority, client=self.client,
+                                                 cost=len(audio) / SAMPLE_RATE)
+            except QueueFullError:
+                self.send_busy()
+                return
+            client = self.client
+            future.add_done_callback(lambda f: self.server.record_inference(self.endpoint(), started, audio_seconds,
+                                                                            self.priority, client))
+        future.add_done_callback(lambda f: segments.put(None))
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        # The length is unknown up front, the end of the stream is the connection closing
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while True:
+                segment = segments.get()
+                if segment is None:
+                    break
+                self.wfile.write((json.dumps(segment) + "\n").encode())
+                self.wfile.flush()
+            if future.exception() is not None:
+                last_line = {"error": str(future.exception())}
+            else:
+                last_line = {"done": True}
+            self.wfile.write((json.dumps(last_line) + "\n").encode())
+        except (BrokenPipeError, ConnectionResetError):
+            disconnected.set()
+
+    def job_from_path(self, job_id):
+        if self.server.jobs is None:
+            self.send_error(404, "Job queue is disabled")
+            return None
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            self.send_error(404, "Unknown job")
+        return job
+
+    def send_job(self, job, status=200):
+        response = {key: job[key] for key in ("status", "model", "created", "started", "finished")}
+        response["job"] = job["id"]
+        if job["status"] == "done":
+            response["text"] = job["text"]
+        elif job["status"] == "failed":
+            response["error"] = job["error"]
+        self.send_json(response, status)
+
+    def session_from_path(self):
+        session = self.server.sessions.get(self.path[len('/whisperaudio/session/'):])
+        if session is None:
+            self.send_error(404, "Unknown session")
+        return session
+
+    def do_DELETE(self):
+        if not self.identify_client():
+            return
+        if self.path.startswith('/whisperaudio/jobs/'):
+            job = self.job_from_path(self.path[len('/whisperaudio/jobs/'):])
+            if job is None:
+                return
+            self.server.jobs.delete(job["id"])
+            self.send_job(job)
+        elif self.path.startswith('/whisperaudio/session/'):
+            session = self.server.sessions.remove(self.path[len('/whisperaudio/session/'):])
+            if session is None:
+                self.send_error(404, "Unknown session")
+                return
+            # Decode whatever audio tail the session still holds
+            self.priority = "realtime"
+            try:
+                text = self.server.pool.run(session.close, priority=self.priority, client=self.client)
+            except QueueFullError:
+                self.send_busy()
+                return
+            self.send_json({"text": text, "transcript": session.text})
+        else:
+            self.send_error(404, "File not found")
+
     def do_POST(self):
-        if self.path == '/whisperaudio':
-            ctype, pdict = cgi.parse_header(self.headers.get('content-type'))
-            if ctype == 'multipart/form-data':
-                pdict['boundary'] = bytes(pdict['boundary'], "utf-8")
-                fields = cgi.parse_multipart(self.rfile, pdict)
-                audio_data = fields.get('audio')[0]
-
-                # Save the audio file temporarily
-                with tempfile.NamedTemporaryFile(delete=False) as temp_audio_file:
-                    temp_audio_file.write(audio_data)
-                    temp_file_path = temp_audio_file.name
+        server = self.server
+        if self.path == '/admin/model':
+            # Body {"model": "<name>"}, switches the default model without a restart
+            if not self.is_admin():
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                model_name = body["model"].strip()
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self.send_error(400, 'Expected a JSON body like {"model": "medium.en"}')
+                return
+            status, response = server.start_model_swap(model_name)
+            self.send_json(response, status)
+            return
+        # Uploads count against the client's limits, opening a session does not
+        if not self.identify_client(limited=self.path != '/whisperaudio/session'):
+            return
+        if self.path == '/whisperaudio/session':
+            self.send_json({"session": server.sessions.open().session_id})
+        elif self.path == '/whisperaudio/jobs':
+            # Durable queue: the upload is stored and the client polls for the result
+            if server.jobs is None:
+                self.send_error(404, "Job queue is disabled")
+                return
+            request = self.read_upload()
+            if request is None:
+                return
+            model_name, audio_data = request
+            key = server.result_key(audio_data, model_name)
+            job_id = server.jobs.submit(model_name, audio_data, key, server.results.get(key), self.client)
+            self.send_job(server.jobs.get(job_id), 202)
+        elif self.path.startswith('/whisperaudio/session/'):
+            session = self.session_from_path()
+            if session is None or not self.choose_priority("realtime"):
+                return
+            request = self.read_upload()
+            if request is None:
+                return
+            model_name, audio_data = request
+            audio = self.decode_upload(audio_data)
+            if audio is None:
+                return
+            started = time.time()
+            try:
+                text = server.pool.run(session.append, server.models.get(model_name), audio, priority=self.priority,
+                                       client=self.client, cost=len(audio) / SAMPLE_RATE)
+            except QueueFullError:
+                self.send_busy()
+                return
+            server.record_inference(self.endpoint(), started, len(audio) / SAMPLE_RATE, self.priority, self.client)
+            self.send_json({"text": text})
+        elif self.path in ('/whisperaudio', '/whisperaudio/stream'):
+            # Refuse before reading the upload when no queue slot is free
+            if not self.choose_priority(DEFAULT_PRIORITY):
+                return
+            if server.pool.is_full(self.priority):
+                self.send_busy()
+                return
+            request = self.read_upload()
+            if request is None:
+                return
+            model_name, audio_data = request
+            del request
+
+            # Repeated uploads of the same audio are answered from the cache, or wait
+            # for the request that is already transcribing it
+            owner = False
+            if self.path == '/whisperaudio':
+                key = server.result_key(audio_data, model_name)
+                transcription = server.results.get(key)
+                if transcription is None:
+                    transcription, owner = server.coalesce(key)
+                if transcription is not None:
+                    self.send_json({"text": transcription})
+                    return
+
+            transcription = None
+            try:
+                audio = self.decode_upload(audio_data)
+                if audio is None:
+                    return
+                # Drop the raw upload before the (possibly long) inference
+                del audio_data
+
+                audio_seconds = len(audio) / SAMPLE_RATE
+                speech_map = None
+                if server.voice_activity is not None:
+                    audio, speech_map = server.voice_activity.compress(audio)
+
+                if self.path == '/whisperaudio/stream':
+                    self.stream_segments(model_name, audio, audio_seconds, speech_map)
+                    return
 
                 try:
-                    # Process the file with Whisper
-                    result = model.transcribe(temp_file_path)
-
-                    # Send response
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    response_data = json.dumps({"text": result["text"]})
-                    self.wfile.write(response_data.encode())
-                finally:
-                    # Clean up the temporary file
-                    os.remove(temp_file_path)
-            else:
-                self.send_error(400, "Invalid content type")
+                    if len(audio) == 0:
+                        transcription = ""
+                    else:
+                        started = time.time()
+                        transcription = server.transcribe(model_name, audio, self.priority, self.client)
+                        server.record_inference(self.endpoint(), started, audio_seconds, self.priority, self.client)
+                except QueueFullError:
+                    self.send_busy()
+                    return
+            finally:
+                if owner:
+                    server.results.finish(key, transcription)
+                elif transcription is not None:
+                    server.results.put(key, transcription)
+
+            # Send response
+            self.send_json({"text": transcription})
         else:
             self.send_error(404, "File not found")
 
-def run(server_class=HTTPServer, handler_class=RequestHandler, port=8000):
-    server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
-    print(f'Server running at http://localhost:{port}/')
+def warmup_audio(seconds):
+    # A voiced tone with light noise, so the model decodes tokens instead of
+    # stopping at a silent window
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    voice = sum(np.sin(2 * np.pi * 150 * k * t) / k for k in range(1, 6)) * 0.1
+    noise = np.random.default_rng(0).normal(0, 0.005, len(t))
+    return (voice + noise).astype(np.float32)
+
+def load_settings(argv=None):
+    parser = argparse.ArgumentParser(description="AI-Scribe Whisper transcription server")
+    parser.add_argument("--config", help="JSON file overriding the default settings")
+    parser.add_argument("--engine", choices=sorted(ENGINES))
+    parser.add_argument("--model")
+    parser.add_argument("--device")
+    parser.add_argument("--compute-type", dest="compute_type")
+    parser.add_argument("--profile", dest="hardware_profile", choices=["auto"] + sorted(PROFILES))
+    parser.add_argument("--cpu-threads", dest="cpu_threads", type=int)
+    parser.add_argument("--num-workers", dest="num_workers", type=int)
+    parser.add_argument("--long-audio-processes", dest="long_audio_processes", type=int)
+    parser.add_argument("--processes", dest="server_processes", type=int, help="server processes sharing the port")
+    parser.add_argument("--port", type=int)
+    args = parser.parse_args(argv)
+
+    settings = dict(default_settings)
+    if args.config:
+        with open(args.config, 'r') as file:
+            for key, value in json.load(file).items():
+                if key in settings:
+                    settings[key] = value
+    for key in ("engine", "model", "device", "compute_type", "hardware_profile", "cpu_threads", "num_workers",
+                "long_audio_processes", "server_processes", "port"):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    return settings
+
+def serve(settings, server_class, handler_class, listen_socket=None, worker=None):
+    httpd = server_class(('', settings["port"]), handler_class, settings, listen_socket, worker)
+    # Requests are accepted while warming up, /readyz tells load balancers when to send them
+    threading.Thread(target=httpd.warm_up, daemon=True).start()
     httpd.serve_forever()
 
+def run(settings, server_class=WhisperServer, handler_class=RequestHandler):
+    print(f'Server running at http://localhost:{settings["port"]}/ with the {settings["engine"]} engine')
+    if settings["server_processes"] <= 1:
+        serve(settings, server_class, handler_class)
+        return
+
+    device = resolve_profile(settings, ENGINES[settings["engine"]])["device"]
+    placements = plan_placements(settings["server_processes"], settings["process_placement"], device)
+    for index, placement in enumerate(placements):
+        print(f"Worker {index}: {describe_placement(placement)}")
+    if settings["jobs_dir"]:
+        # Interrupted jobs are requeued once here instead of by every worker
+        JobStore(settings["jobs_dir"], settings["job_retention_seconds"]).close()
+
+    def start_worker(listen_socket, worker):
+        serve(apply_placement(worker["placement"], settings), server_class, handler_class, listen_socket, worker)
+
+    serve_prefork(settings["port"], placements, start_worker)
+
+def main(argv=None):
+    run(load_settings(argv))
+
 if __name__ == '__main__':
-    run()
+    main()
@@ -0,0 +1,124 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from audio_decode import SAMPLE_RATE
+
+# Seconds at the end of each window that are always decoded again with the next chunk
+OVERLAP_SECONDS = 1.0
+# Longest audio tail carried over; beyond this everything decoded so far is committed
+MAX_TAIL_SECONDS = 10.0
+# Characters of committed text passed to the model as the decoding prompt
+PROMPT_CHARS = 200
+
+
+def _normalize(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+
+def drop_repeated_words(previous_text, new_text, max_words=10):
+    # Removes words at the start of new_text that repeat the end of previous_text
+    previous = [_normalize(w) for w in previous_text.split()[-max_words:]]
+    new_words = new_text.split()
+    normalized = [_normalize(w) for w in new_words[:max_words]]
+    for count in range(min(len(previous), len(normalized)), 0, -1):
+        if previous[-count:] == normalized[:count]:
+            return " ".join(new_words[count:])
+    return new_text.strip()
+
+
+class TranscriptionSession:
+    # Realtime transcription state for one recording. Each chunk is decoded
+    # together with the audio tail of the previous window, segments that end
+    # inside the tail are held back and decoded again with the next chunk so
+    # words are never cut at chunk boundaries.
+    def __init__(self, session_id, transcribe_window, voice_activity=None):
+        self.session_id = session_id
+        self.transcribe_window = transcribe_window
+        self.voice_activity = voice_activity
+        self.tail = np.zeros(0, dtype=np.float32)
+        self.model = None
+        self.language = None
+        self.text = ""
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+
+    def _commit(self, text):
+        text = drop_repeated_words(self.text, text)
+        if text:
+            self.text = f"{self.text} {text}" if self.text else text
+        return text
+
+    def append(self, model, audio, final=False):
+        with self.lock:
+            self.last_used = time.time()
+            self.model = model
+            window = np.concatenate([self.tail, audio]) if len(self.tail) else audio
+            if len(window) == 0:
+                return ""
+            # Nothing to decode in silent windows, only keep the overlap
+            if self.voice_activity is not None and not self.voice_activity.has_speech(window):
+                self.tail = np.zeros(0, dtype=np.float32) if final else window[-int(OVERLAP_SECONDS * SAMPLE_RATE):]
+                return ""
+            prompt = self.text[-PROMPT_CHARS:] or None
+            segments, self.language = self.transcribe_window(model, window, prompt, self.language)
+
+            duration = len(window) / SAMPLE_RATE
+            cut = duration if final else duration - OVERLAP_SECONDS
+            committed = []
+            tail_start = duration
+            for segment in segments:
+                if final or segment["end"] <= cut:
+                    committed.append(segment["text"])
+                else:
+                    tail_start = segment["start"]
+                    break
+            else:
+                tail_start = max(0.0, duration - OVERLAP_SECONDS)
+            if duration - tail_start > MAX_TAIL_SECONDS:
+                committed = [segment["text"] for segment in segments]
+                tail_start = max(0.0, duration - OVERLAP_SECONDS)
+
+            self.tail = np.zeros(0, dtype=np.float32) if final else window[int(tail_start * SAMPLE_RATE):]
+            return self._commit(" ".join(text.strip() for text in committed))
+
+    def close(self):
+        if self.model is None:
+            return ""
+        return self.append(self.model, np.zeros(0, dtype=np.float32), final=True)
+
+
+class SessionStore:
+    def __init__(self, transcribe_window, voice_activity=None, idle_timeout=600):
+        self.transcribe_window = transcribe_window
+        self.voice_activity = voice_activity
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def open(self):
+        session = TranscriptionSession(uuid.uuid4().hex, self.transcribe_window, self.voice_activity)
+        with self.lock:
+            self._expire()
+            self.sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            self._expire()
+            return self.sessions.get(session_id)
+
+    def remove(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None)
+
+    def _expire(self):
+        now = time.time()
+        for session_id in [s for s, session in self.sessions.items() if now - session.last_used > self.idle_timeout]:
+            del self.sessions[session_id]
@@ -0,0 +1,114 @@
+# Copyright (c) 2023 Braedon Hendy
+# This software is released under the GNU General Public License v3.0
+
+from bisect import bisect_right
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+class SpeechMap:
+    # Maps times in the silence-compressed audio back to the original recording.
+    # spans holds (compressed_start, original_start, length) in samples.
+    def __init__(self, spans, sample_rate=SAMPLE_RATE):
+        self.spans = spans
+        self.sample_rate = sample_rate
+        self.starts = [span[0] for span in spans]
+
+    def to_original(self, seconds):
+        if not self.spans:
+            return seconds
+        sample = seconds * self.sample_rate
+        index = max(0, bisect_right(self.starts, sample) - 1)
+        compressed_start, original_start, length = self.spans[index]
+        offset = min(max(sample - compressed_start, 0), length)
+        return (original_start + offset) / self.sample_rate
+
+    def restore_segments(self, segments):
+        for segment in segments:
+            segment["start"] = self.to_original(segment["start"])
+            segment["end"] = self.to_original(segment["end"])
+        return segments
+
+    def speech_seconds(self):
+        return sum(span[2] for span in self.spans) / self.sample_rate
+
+
+class EnergyVAD:
+    # Frame energy / zero-crossing voice activity detection in NumPy. Silences
+    # longer than min_silence are cut down to keep_silence seconds so inference
+    # time follows the amount of speech, not the length of the recording.
+    # Speech frames are threshold_db above the recording's noise floor; only
+    # audio that stays below min_energy_db counts as silent, so quiet speech
+    # over a fan or HVAC noise is still transcribed, just not compressed.
+    def __init__(self, frame_seconds=0.03, threshold_db=6.0, min_energy_db=-55.0,
+                 min_silence=1.0, keep_silence=0.4, sample_rate=SAMPLE_RATE):
+        self.frame = int(frame_seconds * sample_rate)
+        self.threshold_db = threshold_db
+        self.min_energy_db = min_energy_db
+        self.min_silence = min_silence
+        self.keep_silence = keep_silence
+        self.sample_rate = sample_rate
+
+    def options(self):
+        # Everything that changes which audio reaches the model
+        return {"frame": self.frame, "threshold_db": self.threshold_db, "min_energy_db": self.min_energy_db,
+                "min_silence": self.min_silence, "keep_silence": self.keep_silence, "sample_rate": self.sample_rate}
+
+    def _frames(self, audio):
+        count = len(audio) // self.frame
+        frames = audio[:count * self.frame].reshape(count, self.frame)
+        return frames, 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+
+    def speech_frames(self, audio):
+        frames, energy = self._frames(audio)
+        if len(energy) == 0:
+            return np.zeros(0, dtype=bool)
+        crossings = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+        noise_floor = np.percentile(energy, 10)
+        loud = energy > max(noise_floor + self.threshold_db, self.min_energy_db)
+        # Unvoiced consonants are quiet but cross zero often
+        fricative = (energy > max(noise_floor + self.threshold_db / 2, self.min_energy_db)) & (crossings > 0.3)
+        return loud | fricative
+
+    def has_speech(self, audio):
+        _, energy = self._frames(audio)
+        return bool((energy > self.min_energy_db).any())
+
+    def compress(self, audio):
+        speech = self.speech_frames(audio)
+        if not speech.any():
+            if not self.has_speech(audio):
+                return audio[:0], SpeechMap([], self.sample_rate)
+            # Sound without a clear speech/noise contrast is kept whole
+            return audio, SpeechMap([(0, 0, len(audio))], self.sample_rate)
+
+        # Widen speech by half the kept silence on both sides; gaps that are
+        # still shorter than min_silence are kept whole
+        pad = int(round(self.keep_silence / 2 * self.sample_rate / self.frame))
+        if pad:
+            speech = np.convolve(speech, np.ones(2 * pad + 1), mode="same") > 0
+        edges = np.flatnonzero(np.diff(np.concatenate([[False], speech, [False]]).astype(np.int8)))
+        regions = edges.reshape(-1, 2) * self.frame
+        if speech[-1]:
+            regions[-1, 1] = len(audio)
+
+        merged = [list(regions[0])]
+        min_gap = int(self.min_silence * self.sample_rate)
+        for start, end in regions[1:]:
+            if start - merged[-1][1] < min_gap:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end])
+
+        spans = []
+        pieces = []
+        position = 0
+        for start, end in merged:
+            spans.append((position, int(start), int(end - start)))
+            pieces.append(audio[start:end])
+            position += int(end - start)
+        if len(merged) == 1 and merged[0][0] == 0 and merged[0][1] >= len(audio):
+            return audio, SpeechMap(spans, self.sample_rate)
+        return np.concatenate(pieces), SpeechMap(spans, self.sample_rate)